@@ -0,0 +1,351 @@
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import Logic
+import Client
+import CreateDB
+import Protocol
+
+
+def SeedDatabase(dbName, numStudents, seed=0):
+    """
+    Create a students database holding numStudents generated students.
+    """
+
+    return CreateDB.CreateDatabase(dbName, numStudents, seed)
+
+
+def MakeStudents(numStudents, seed=0):
+    """
+    Return numStudents synthetic (ID, first name, last name) rows, read back
+    through sqlite3 so every value is a separate object as on the server.
+    """
+
+    conn = SeedDatabase(':memory:', numStudents, seed)
+    rows = conn.execute('SELECT * FROM students').fetchall()
+    conn.close()
+    return rows
+
+
+def Timed(function, repeat):
+    """
+    Return the best wall time of several calls to function, and its result.
+    """
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def BenchmarkFormats(numStudents, repeat=5):
+    """
+    Compare the reply formats served by LogicLayer: pickled rows, pickled 
+    DataFrame and columnar. Encoding starts from rows as fetched from 
+    sqlite3, so it includes building the DataFrame or columns.
+
+    OUTPUT:
+      results - Dictionary per format with payload size in bytes and the
+                encode, lazy decode and full decode times in seconds
+    """
+
+    import pandas as pd
+
+    columns = ['ID', 'First Name', 'Last Name']
+    rows = MakeStudents(numStudents)
+
+    def EncodeColumnar():
+        columnValues = [list(column) for column in zip(*rows)] or [[], [], []]
+        return Protocol.EncodeColumnar(columns, columnValues)
+
+    results = {}
+
+    encodeTime, payload = Timed(lambda: pickle.dumps(rows), repeat)
+    decodeTime, decoded = Timed(lambda: pickle.loads(payload), repeat)
+    results['pickle'] = {'bytes':len(payload), 'encode':encodeTime,
+                         'decode':decodeTime, 'decodeRows':decodeTime}
+
+    encodeTime, payload = Timed(
+        lambda: pickle.dumps(pd.DataFrame(rows, columns=columns)), repeat)
+    decodeTime, decoded = Timed(lambda: pickle.loads(payload), repeat)
+    rowsTime, _ = Timed(lambda: decoded.values.tolist(), repeat)
+    results['dataframe'] = {'bytes':len(payload), 'encode':encodeTime,
+                            'decode':decodeTime,
+                            'decodeRows':decodeTime + rowsTime}
+
+    encodeTime, payload = Timed(EncodeColumnar, repeat)
+    decodeTime, decoded = Timed(lambda: Protocol.ColumnarTable(payload),
+                                repeat)
+    rowsTime, _ = Timed(decoded.Rows, repeat)
+    results['columnar'] = {'bytes':len(payload), 'encode':encodeTime,
+                           'decode':decodeTime,
+                           'decodeRows':decodeTime + rowsTime}
+
+    return results
+
+
+def Percentiles(latencies):
+    """
+    Summarize a list of latencies in seconds.
+    """
+
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'count':0}
+
+    def Percentile(p):
+        return latencies[min(int(p / 100 * len(latencies)), 
+                             len(latencies) - 1)]
+
+    return {'count':len(latencies),
+            'mean':sum(latencies) / len(latencies),
+            'p50':Percentile(50), 'p95':Percentile(95), 'p99':Percentile(99),
+            'max':latencies[-1]}
+
+
+def StartServer(dbName, serverArgs=(), workers=8):
+    """
+    Start Logic.py serving dbName on a free port.
+
+    OUTPUT:
+      process - The server process
+      port    - Port it listens on
+    """
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    logicPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'Logic.py')
+    process = subprocess.Popen([sys.executable, logicPath, '--db', dbName,
+                                '--port', str(port), '--serve-async',
+                                '--workers', str(workers)] + list(serverArgs))
+
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process, port
+        except ConnectionRefusedError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError('Server did not start')
+            time.sleep(0.05)
+
+
+def RunClient(port, mix, numStudents, duration, seed, latencies):
+    """
+    Issue requests drawn from mix, one at a time, until duration has passed,
+    appending (command, seconds) for each to latencies.
+    """
+
+    rand = random.Random(seed)
+    commands = list(mix)
+    weights = [mix[cmd] for cmd in commands]
+
+    with Client.StudentClient('127.0.0.1', port) as client:
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            cmd = rand.choices(commands, weights)[0]
+            id = rand.randint(1, max(numStudents, 1))
+            firstName = rand.choice(CreateDB.FIRST_NAMES)
+            lastName = rand.choice(CreateDB.LAST_NAMES)
+
+            start = time.perf_counter()
+            if cmd == 'GetStudents':
+                future = client.GetStudents()
+            elif cmd == 'AddStudent':
+                future = client.AddStudent(firstName, lastName)
+            elif cmd == 'UpdateStudent':
+                future = client.UpdateStudent(id, firstName, lastName)
+            elif cmd == 'DeleteStudent':
+                future = client.DeleteStudent(id)
+            else:
+                raise ValueError('Unknown command %r' % cmd)
+            future.result()
+            latencies.append((cmd, time.perf_counter() - start))
+
+
+def BenchmarkLoad(numStudents, numClients=8, mix=None, duration=10.0,
+                  serverArgs=(), workers=8):
+    """
+    Drive a real server over TCP with concurrent synthetic clients.
+
+    INPUT:
+      numStudents - Students in the seeded database
+      numClients  - Concurrent client connections
+      mix         - Dictionary of command name to relative weight
+      duration    - Seconds each client runs for
+      serverArgs  - Extra command line arguments for Logic.py
+      workers     - Server worker threads
+
+    OUTPUT:
+      results - Dictionary with overall throughput and per-command latency
+                percentiles in seconds
+    """
+
+    if mix is None:
+        mix = {'GetStudents':1, 'AddStudent':3, 'UpdateStudent':3,
+               'DeleteStudent':1}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        dbName = os.path.join(tempDir, 'students.db')
+        SeedDatabase(dbName, numStudents).close()
+        process, port = StartServer(dbName, serverArgs, workers)
+
+        latencies = []
+        try:
+            threads = [threading.Thread(target=RunClient,
+                                        args=(port, mix, numStudents,
+                                              duration, i, latencies))
+                       for i in range(numClients)]
+            start = time.perf_counter()
+            [thread.start() for thread in threads]
+            [thread.join() for thread in threads]
+            elapsed = time.perf_counter() - start
+        finally:
+            process.terminate()
+            process.wait()
+
+    results = {'students':numStudents, 'clients':numClients, 'mix':mix,
+               'serverArgs':list(serverArgs), 'seconds':elapsed,
+               'requests':len(latencies),
+               'throughput':len(latencies) / elapsed,
+               'latency':{'all':Percentiles([l for c, l in latencies])}}
+    for cmd in mix:
+        results['latency'][cmd] = Percentiles([l for c, l in latencies
+                                               if c == cmd])
+    return results
+
+
+def BenchmarkProfiles(numStudents, profiles=None, serverArgs=(), **kwargs):
+    """
+    Run BenchmarkLoad once per storage tuning profile, on identical seeded
+    databases.
+
+    INPUT:
+      numStudents - Students in the seeded database
+      profiles    - Names from Logic.TUNING_PROFILES (default: all)
+      serverArgs  - Extra command line arguments for Logic.py
+      **kwargs    - Other BenchmarkLoad arguments
+
+    OUTPUT:
+      results - Dictionary of profile name to BenchmarkLoad results
+    """
+
+    if profiles is None:
+        profiles = list(Logic.TUNING_PROFILES)
+
+    return {profile:BenchmarkLoad(numStudents, 
+                                  serverArgs=['--profile', profile] + 
+                                             list(serverArgs), 
+                                  **kwargs)
+            for profile in profiles}
+
+
+def ParseMix(text):
+    """
+    Parse a mix such as 'GetStudents=1,AddStudent=3'.
+    """
+
+    mix = {}
+    for item in text.split(','):
+        cmd, weight = item.split('=')
+        mix[cmd.strip()] = float(weight)
+    return mix
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Student database benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    # Options taken by every benchmark, after its name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--output', help='Write the JSON report to a file')
+
+    formatParser = subparsers.add_parser(
+        'formats', help='Compare reply formats', parents=[common])
+    formatParser.add_argument('--students', type=int, nargs='+',
+                              default=[1000, 100000])
+    formatParser.add_argument('--repeat', type=int, default=5)
+
+    loadParser = subparsers.add_parser(
+        'load', help='Drive a server with concurrent clients', 
+        parents=[common])
+    loadParser.add_argument('--students', type=int, nargs='+',
+                            default=[1000, 100000, 1000000])
+    loadParser.add_argument('--clients', type=int, default=8)
+    loadParser.add_argument('--duration', type=float, default=10.0,
+                            help='Seconds per run')
+    loadParser.add_argument('--mix', type=ParseMix,
+                            default='GetStudents=1,AddStudent=3,'
+                                    'UpdateStudent=3,DeleteStudent=1',
+                            help='Command weights, e.g. GetStudents=1,'
+                                 'AddStudent=3')
+    loadParser.add_argument('--workers', type=int, default=8,
+                            help='Server worker threads')
+    loadParser.add_argument('--server-args', default='',
+                            help='Extra arguments for Logic.py, e.g. '
+                                 '"--durability group"')
+
+    profileParser = subparsers.add_parser(
+        'profiles', help='Compare storage tuning profiles under load',
+        parents=[common])
+    profileParser.add_argument('--students', type=int, nargs='+',
+                               default=[100000, 1000000])
+    profileParser.add_argument('--profiles', nargs='+',
+                               choices=list(Logic.TUNING_PROFILES),
+                               help='Profiles to compare (default: all)')
+    profileParser.add_argument('--clients', type=int, default=8)
+    profileParser.add_argument('--duration', type=float, default=10.0,
+                               help='Seconds per run')
+    profileParser.add_argument('--mix', type=ParseMix,
+                               default='GetStudents=4,AddStudent=1,'
+                                       'UpdateStudent=1',
+                               help='Command weights, e.g. GetStudents=1,'
+                                    'AddStudent=3')
+    profileParser.add_argument('--workers', type=int, default=8,
+                               help='Server worker threads')
+    profileParser.add_argument('--server-args', default='',
+                               help='Extra arguments for Logic.py, e.g. '
+                                    '"--read-pool-size 4"')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'formats':
+        report = {str(n):BenchmarkFormats(n, args.repeat)
+                  for n in args.students}
+
+    elif args.benchmark == 'load':
+        report = [BenchmarkLoad(n, args.clients, args.mix, args.duration,
+                                args.server_args.split(), args.workers)
+                  for n in args.students]
+
+    elif args.benchmark == 'profiles':
+        report = {str(n):BenchmarkProfiles(n, args.profiles, 
+                                           args.server_args.split(),
+                                           numClients=args.clients, 
+                                           mix=args.mix,
+                                           duration=args.duration,
+                                           workers=args.workers)
+                  for n in args.students}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,333 @@
+import socket
+import pickle
+import itertools
+import threading
+
+import Protocol
+
+from concurrent.futures import Future
+
+
+class RequestError(Exception):
+    """
+    The server failed to carry out a request.
+    """
+
+
+class StudentClient:
+    """
+    Client for the database logic layer server, without any GUI.
+
+    Every request is tagged with an ID and returns a Future at once, so many
+    requests can be in flight on one connection. A background thread reads
+    the replies and completes the matching futures in whatever order the
+    replies arrive.
+
+    INPUT:
+      TCP_IP      - IP address
+      TCP_PORT    - Port
+      compression - Offer to compress large messages (see 
+                    LogicLayer.Negotiate)
+    """
+
+    def __init__(self, TCP_IP='127.0.0.1', TCP_PORT=5005, compression=True):
+
+        clientInitMsg = b'Hello Logic'
+        serverInitReply = b'Hello UI'
+
+        self.sock = socket.create_connection((TCP_IP, TCP_PORT))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(clientInitMsg)
+
+        buff = bytearray(len(serverInitReply))
+        Protocol.ReceiveExactly(self.sock, memoryview(buff))
+        if buff != serverInitReply:
+            self.sock.close()
+            raise ConnectionError('Unexpected reply to hello: %r' % buff)
+
+        self.requestIDs = itertools.count(1)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.sendLock = threading.Lock()
+        self.closed = False
+        self.compressAbove = None
+
+        self.readerThread = threading.Thread(target=self._ReadReplies,
+                                             daemon=True)
+        self.readerThread.start()
+
+        if compression:
+            agreed = self.Request('Negotiate', {'compression':['zlib']})
+            self.compressAbove = agreed.result()['compressAbove']
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.Close()
+
+
+    def Request(self, cmd, data=None, fmt=None, OnChunk=None):
+        """
+        Send a command without waiting for its reply.
+
+        INPUT:
+          cmd     - Command name, as handled by LogicLayer.ProcessMessage
+          data    - Command data dictionary
+          fmt     - Reply format for table queries ('pickle', 'dataframe' or
+                    'columnar')
+          OnChunk - For commands replying with a stream of messages, function
+                    called from the reader thread with the body of each 
+                    message (a memoryview) until the empty end of stream
+
+        OUTPUT:
+          future - Future completed with the decoded reply, or for a stream
+                   with None once it has ended. If the server fails to carry
+                   out the request, the future raises RequestError.
+        """
+
+        reqID = next(self.requestIDs)
+        msgdict = {'cmd':cmd, 'reqID':reqID}
+        if data is not None:
+            msgdict['data'] = data
+        if fmt is not None:
+            msgdict['format'] = fmt
+
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError('Client is closed')
+            self.pending[reqID] = (future, fmt, OnChunk)
+
+        sendmsg = pickle.dumps(msgdict)
+        with self.sendLock:
+            Protocol.SendMessage(self.sock, sendmsg, 
+                                 compressAbove=self.compressAbove)
+        return future
+
+
+    def _ReadReplies(self):
+        """
+        Complete pending futures with replies until the connection closes.
+        """
+
+        error = ConnectionError('Connection closed')
+        while True:
+            try:
+                msg = Protocol.ReceiveMessage(self.sock, tagged=True)
+            except OSError as e:
+                error = e
+                msg = None
+            if msg is None:
+                break
+
+            reqID, body = Protocol.SplitRequestID(msg)
+            if reqID < 0:
+                self._HandleError(-reqID, body)
+                continue
+
+            with self.lock:
+                future, fmt, OnChunk = self.pending.get(reqID, 
+                                                        (None, None, None))
+                if future is not None and (OnChunk is None or not body):
+                    del self.pending[reqID]
+            if future is None:
+                continue
+
+            if OnChunk is not None:
+                self._HandleChunk(reqID, future, OnChunk, body)
+                continue
+
+            try:
+                if fmt == 'columnar':
+                    result = Protocol.ColumnarTable(body)
+                else:
+                    result = pickle.loads(body)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future, fmt, OnChunk in pending:
+            future.set_exception(error)
+
+
+    def _HandleError(self, reqID, body):
+        """
+        Fail a request the server reports it could not carry out, dropping 
+        the rest of its stream if it had one.
+        """
+
+        with self.lock:
+            future, fmt, OnChunk = self.pending.pop(reqID, (None, None, None))
+        if future is not None:
+            future.set_exception(RequestError(pickle.loads(body)['error']))
+
+
+    def _HandleChunk(self, reqID, future, OnChunk, body):
+        """
+        Pass one message of a stream to its handler, completing the future
+        at the end of the stream or if the handler fails.
+        """
+
+        if not body:
+            future.set_result(None)
+            return
+
+        try:
+            OnChunk(body)
+        except Exception as e:
+            # Drop the rest of the stream
+            with self.lock:
+                self.pending.pop(reqID, None)
+            future.set_exception(e)
+
+
+    def Close(self):
+        """
+        Tell the server to close the connection and stop reading replies.
+        """
+
+        with self.lock:
+            closed = self.closed
+            self.closed = True
+        if not closed:
+            try:
+                with self.sendLock:
+                    Protocol.SendMessage(self.sock,
+                                         pickle.dumps({'cmd':'CloseSocket'}))
+                self.sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        self.readerThread.join()
+        self.sock.close()
+
+
+    def GetStudents(self, fmt='pickle'):
+        return self.Request('GetStudents', fmt=fmt)
+
+
+    def GetStudentsPage(self, pageSize=100, cursor=None):
+        return self.Request('GetStudentsPage', {'pageSize':pageSize,
+                                                'cursor':cursor})
+
+
+    def SearchStudents(self, fmt='pickle', **criteria):
+        """
+        Search by name; criteria are the arguments of
+        LogicLayer.SearchStudents.
+        """
+
+        return self.Request('SearchStudents', criteria, fmt=fmt)
+
+
+    def CountStudents(self):
+        return self.Request('CountStudents')
+
+
+    def CountByName(self, column='last_name', length=1, prefix=''):
+        return self.Request('CountByName', {'column':column, 'length':length,
+                                            'prefix':prefix})
+
+
+    def CountDuplicates(self):
+        return self.Request('CountDuplicates')
+
+
+    def GetStudentsSince(self, version=None, epoch=None):
+        return self.Request('GetStudentsSince', {'version':version,
+                                                 'epoch':epoch})
+
+
+    def ExportStudents(self, f, fmt='csv', chunkSize=1000):
+        """
+        Write every student to a file as the chunks arrive, so memory use 
+        does not grow with the table.
+
+        INPUT:
+          f         - Binary file object to write to
+          fmt       - 'csv' to write a CSV file, or a GetStudents format, in 
+                      which case each chunk is written preceded by its size
+                      as in Protocol.SendMessage
+          chunkSize - Maximum number of students per chunk
+
+        OUTPUT:
+          future - Future completed once the whole table is written
+        """
+
+        def OnChunk(chunk):
+            if fmt != 'csv':
+                f.write(Protocol.HEADER.pack(len(chunk)))
+            f.write(chunk)
+
+        return self.Request('ExportStudents', {'format':fmt,
+                                               'chunkSize':chunkSize},
+                            OnChunk=OnChunk)
+
+
+    def StreamStudents(self, OnBatch, batchSize=1000):
+        """
+        Receive every student in batches, as the server fetches them.
+
+        INPUT:
+          OnBatch   - Function called from the reader thread with each 
+                      batch, a dictionary described in 
+                      LogicLayer.StreamStudents
+          batchSize - Maximum number of students per batch
+
+        OUTPUT:
+          future - Future completed once the last batch has been handled
+        """
+
+        return self.Request('StreamStudents', {'batchSize':batchSize},
+                            OnChunk=lambda body: OnBatch(pickle.loads(body)))
+
+
+    def Subscribe(self, OnEvent):
+        """
+        Have change events pushed to this client as changes are committed.
+
+        INPUT:
+          OnEvent - Function called from the reader thread with each event,
+                    a dictionary described in Logic.Subscription
+
+        OUTPUT:
+          future - Future completed once Unsubscribe has ended the events
+        """
+
+        return self.Request('Subscribe', 
+                            OnChunk=lambda body: OnEvent(pickle.loads(body)))
+
+
+    def Unsubscribe(self):
+        return self.Request('Unsubscribe')
+
+
+    def GetStats(self):
+        return self.Request('GetStats')
+
+
+    def AddStudent(self, firstName, lastName):
+        return self.Request('AddStudent',
+                            {'values':{'first_name':firstName,
+                                       'last_name':lastName}})
+
+
+    def UpdateStudent(self, id, firstName, lastName):
+        return self.Request('UpdateStudent',
+                            {'ID':id, 'values':{'first_name':firstName,
+                                                'last_name':lastName}})
+
+
+    def DeleteStudent(self, id):
+        return self.Request('DeleteStudent', {'ID':id})
+
+
+    def Batch(self, ops):
+        return self.Request('Batch', {'ops':ops})
@@ -1,15 +1,129 @@
+import os
+import random
 import sqlite3
+import argparse
+import itertools
 
-conn = sqlite3.connect('students.db')
-c = conn.cursor()
-c.execute('''CREATE TABLE students (id INTEGER PRIMARY KEY, 
-                                    first_name, last_name)''')
+import Logic
 
-c.execute("INSERT INTO students VALUES (null, 'Alyssa', 'Batula')")
-c.execute("INSERT INTO students VALUES (null, 'Kaylee', 'Frye')")
-c.execute("INSERT INTO students VALUES (null, 'Harry', 'Potter')")
-c.execute("INSERT INTO students VALUES (null, 'Jon', 'Snow')")
-c.execute("INSERT INTO students VALUES (null, 'Clara', 'Oswald')")
-c.execute("INSERT INTO students VALUES (null, 'Anthony', 'Stark')")
 
-conn.commit()
+# The students every database starts with
+CLASSIC_STUDENTS = [('Alyssa', 'Batula'),
+                    ('Kaylee', 'Frye'),
+                    ('Harry', 'Potter'),
+                    ('Jon', 'Snow'),
+                    ('Clara', 'Oswald'),
+                    ('Anthony', 'Stark')]
+
+# Names for generated students, most common first. A name's weight falls off
+# with its rank, as real name frequencies do, so a few names are shared by
+# many students and most by few.
+FIRST_NAMES = ['James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer',
+               'Michael', 'Linda', 'David', 'Elizabeth', 'William', 'Susan',
+               'Maria', 'José', 'Sarah', 'Daniel', 'Karen', 'Wei', 'Nancy',
+               'Anthony', 'Lisa', 'Mohammed', 'Sofía', 'Harry', 'Emily',
+               'Jon', 'Clara', 'Luke', 'Leia', 'Alyssa', 'Kaylee', 'Hermione',
+               'Arya', 'Zoë', 'François', 'Björn', 'Chloé', 'Malcolm',
+               'Søren', 'Aoife']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia',
+              'Miller', 'Davis', 'Rodriguez', 'Martinez', 'Hernández',
+              'Lopez', 'Wang', 'Wilson', 'Anderson', 'Thomas', 'Taylor',
+              'Moore', 'Nguyen', 'Martin', 'Lee', 'Müller', 'Núñez', 'Stark',
+              'Potter', 'Snow', 'Oswald', 'Frye', 'Batula', 'Skywalker',
+              'Organa', 'Granger', 'Noble', 'Reynolds', "O'Brien", 'Wójcik',
+              'Østergaard', 'Dubois', 'Washburne', 'Kowalski']
+
+
+def GenerateStudents(numStudents, seed=0):
+    """
+    Generate names for numStudents students: the classic students first,
+    then random ones drawn with realistic name frequencies.
+
+    INPUT:
+      numStudents - Number of students
+      seed        - Random seed; the same seed always gives the same names
+
+    OUTPUT:
+      (first name, last name) tuples
+    """
+
+    yield from CLASSIC_STUDENTS[:numStudents]
+
+    rand = random.Random(seed)
+    firstWeights = list(itertools.accumulate(
+        1 / rank for rank in range(1, len(FIRST_NAMES) + 1)))
+    lastWeights = list(itertools.accumulate(
+        1 / rank for rank in range(1, len(LAST_NAMES) + 1)))
+    for i in range(numStudents - len(CLASSIC_STUDENTS)):
+        yield (rand.choices(FIRST_NAMES, cum_weights=firstWeights)[0],
+               rand.choices(LAST_NAMES, cum_weights=lastWeights)[0])
+
+
+def CreateDatabase(dbName='students.db', numStudents=len(CLASSIC_STUDENTS),
+                   seed=0, batchSize=10000):
+    """
+    Create a students database filled with generated students.
+
+    The table is typed (STRICT where SQLite supports it) and its indexes are
+    built after the students are inserted, which is faster than updating them
+    row by row. The database is marked as already migrated.
+
+    INPUT:
+      dbName      - Path to database (must not already have a students table)
+      numStudents - Number of students (see GenerateStudents)
+      seed        - Random seed for the generated names
+      batchSize   - Students inserted per executemany call
+
+    OUTPUT:
+      conn - Open connection to the new database
+    """
+
+    strict = ' STRICT' if sqlite3.sqlite_version_info >= (3, 37) else ''
+
+    conn = sqlite3.connect(dbName)
+    c = conn.cursor()
+
+    # Settings for the bulk load only; none of them are stored in the file
+    c.execute('PRAGMA synchronous = OFF')
+    c.execute('PRAGMA cache_size = -65536')
+    c.execute('PRAGMA temp_store = MEMORY')
+
+    c.execute('''CREATE TABLE students (id INTEGER PRIMARY KEY,
+                                        first_name TEXT NOT NULL,
+                                        last_name TEXT NOT NULL)''' + strict)
+
+    students = GenerateStudents(numStudents, seed)
+    while True:
+        batch = list(itertools.islice(students, batchSize))
+        if not batch:
+            break
+        c.executemany('INSERT INTO students (first_name, last_name) '
+                      'VALUES (?,?)', batch)
+
+    for migration in Logic.SCHEMA_MIGRATIONS:
+        c.execute(migration)
+    c.execute('PRAGMA user_version = %d' % len(Logic.SCHEMA_MIGRATIONS))
+    c.execute('ANALYZE')
+    conn.commit()
+
+    c.execute('PRAGMA synchronous = FULL')
+    return conn
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Create a students database')
+    parser.add_argument('--db', default='students.db',
+                        help='Path to database')
+    parser.add_argument('--students', type=int,
+                        default=len(CLASSIC_STUDENTS),
+                        help='Number of students')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for generated names')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Replace the database if it exists')
+    args = parser.parse_args()
+
+    if args.overwrite and os.path.exists(args.db):
+        os.remove(args.db)
+    CreateDatabase(args.db, args.students, args.seed).close()
@@ -1,9 +1,8 @@
 import sys
-import socket
-import pickle
-import struct
 import atexit
-import pandas as pd
+import bisect
+
+import Client
 
 from PyQt5 import QtWidgets, QtCore, QtGui
 
@@ -11,8 +10,22 @@ from PyQt5 import QtWidgets, QtCore, QtGui
 class MainUI(QtWidgets.QMainWindow):
     """
     GUI for interacting with database logic.
+
+    All network traffic goes through a Client.StudentClient, so the window 
+    never blocks on the socket. Replies arrive on the client's reader thread
+    and are passed to the GUI thread through the replyReceived signal.
     """
 
+    # Handlers to call on success and on failure, and the completed Future
+    # holding the reply
+    replyReceived = QtCore.pyqtSignal(object, object, object)
+
+    # Change event pushed by the server
+    eventReceived = QtCore.pyqtSignal(object)
+
+    # Batch of students streamed by the server
+    batchReceived = QtCore.pyqtSignal(object)
+
     
     def __init__(self, TCP_IP='127.0.0.1', TCP_PORT=5005):
         """
@@ -24,7 +37,19 @@ class MainUI(QtWidgets.QMainWindow):
         """
         super().__init__()
 
-        self.studentDF = None
+        # Local copy of the students table, kept sorted by ID, and the 
+        # server version it reflects
+        self.students = []
+        self.studentIDs = []
+        self.studentVersion = None
+        self.studentEpoch = None
+
+        self.client = None
+        self.refreshPending = False
+        self.refreshQueued = False
+        self.replyReceived.connect(self.HandleReply)
+        self.eventReceived.connect(self.ApplyPushedEvent)
+        self.batchReceived.connect(self.AppendStudents)
 
         atexit.register(self.CleanupFunction)
         
@@ -105,64 +130,230 @@ class MainUI(QtWidgets.QMainWindow):
           TCP_PORT - Port
         """
         
-        clientInitMsg = b'Hello Logic'
-        serverInitReply = b'Hello UI'
-
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.sock.connect((TCP_IP, TCP_PORT))
+            self.client = Client.StudentClient(TCP_IP, TCP_PORT)
         except ConnectionRefusedError:
             self.socketConnected = False
             print('ERROR: Socket connection refused')
+        except OSError:
+            self.socketConnected = False
+            print('Socket Closed')
         else:
-            # Send initial welcome
-            self.sock.sendall(clientInitMsg)
+            self.socketConnected = True
+
+            # Other clients' changes show up without polling
+            self.SendRequest(self.client.Subscribe(self.eventReceived.emit))
+
+                
+    def SendRequest(self, future, handler=None, OnError=None):
+        """
+        Call handler with the reply to a request once it arrives, on the GUI
+        thread.
+
+        INPUT:
+          future  - Future returned by the client
+          handler - Function taking the reply (None to only report errors)
+          OnError - Function called instead of handler if the request fails
+        """
+
+        future.add_done_callback(
+            lambda future: self.replyReceived.emit(handler, OnError, future))
+
+
+    def HandleReply(self, handler, OnError, future):
+        """
+        Pass a reply to its handler. Runs on the GUI thread.
+        """
+
+        try:
+            reply = future.result()
+        except Exception as e:
+            print('ERROR: Request failed: %s' % e)
+            self.ShowLoading(False)
+            if OnError is not None:
+                OnError()
+            return
+
+        if handler is not None:
+            handler(reply)
+
 
-            # Receive welcome message 
-            try:
-                buff = self.sock.recv(len(serverInitReply))
-            except (socket.timeout, ConnectionResetError):
-                self.sock.close()
-                print('Socket Closed')
+    def ShowLoading(self, loading):
+        """
+        Show or clear the loading indicator.
+        """
 
-            if buff == serverInitReply:
-                self.socketConnected = True
+        if loading:
+            self.statusBar().showMessage('Loading students...')
+        else:
+            self.statusBar().clearMessage()
 
                 
     def UpdateStudentList(self):
         """
-        Get all students from the database and display them in the GUI.
+        Request the students that changed since the last update from the 
+        database. The list is patched when the reply arrives, or on the 
+        first update filled in batch by batch as the students stream in.
         """
-        buffSize = 1024
+
+        if self.client is None:
+            return
+
+        # One refresh at a time; a request made meanwhile runs afterwards
+        if self.refreshPending:
+            self.refreshQueued = True
+            return
+        self.refreshPending = True
+        self.ShowLoading(True)
+
+        if self.studentVersion is None:
+            self.studentList.clear()
+            self.students = []
+            self.studentIDs = []
+            future = self.client.StreamStudents(self.batchReceived.emit)
+            self.SendRequest(future, lambda reply: self.FinishRefresh(),
+                             self.FailRefresh)
+            return
         
-        # Get list of students
-        msgdict = {'cmd':'GetStudents'}
-        sendmsg = pickle.dumps(msgdict)
-        sizemsg = struct.pack('<i',len(sendmsg))
-        self.sock.sendall(sizemsg)
-        self.sock.sendall(sendmsg)
-
-        # Get data from the server
-        buff = self.sock.recv(buffSize)
-        msg = buff
-
-        # Keep reading until message complete
-        while len(buff) == buffSize:
-            buff = self.sock.recv(buffSize)
-            msg += buff
-
-        # Format for display
-        self.studentDF = pickle.loads(msg)
-        dflist = self.studentDF.loc[:,['First Name',
-                                       'Last Name']].values.tolist()
-        students = [' '.join(x) for x in dflist]
+        # Get changes to the list of students
+        future = self.client.GetStudentsSince(self.studentVersion,
+                                              self.studentEpoch)
+        self.SendRequest(future, self.ApplyStudentUpdate, self.FailRefresh)
+
+
+    def ApplyStudentUpdate(self, reply):
+        """
+        Display the students from a GetStudentsSince reply.
+
+        INPUT:
+          reply - Dictionary returned by LogicLayer.GetStudentsSince
+        """
+
+        if reply['reset']:
+            self.ResetStudentList(reply['students'])
+        else:
+            for change in reply['changes']:
+                self.ApplyStudentChange(*change[1:])
+
+        self.studentVersion = reply['version']
+        self.studentEpoch = reply['epoch']
+        self.FinishRefresh()
+
+
+    def AppendStudents(self, batch):
+        """
+        Display the next batch of streamed students. Runs on the GUI thread.
+
+        INPUT:
+          batch - Dictionary described in LogicLayer.StreamStudents
+        """
+
+        students = batch['students']
+        self.students += students
+        self.studentIDs += [student[0] for student in students]
+        self.studentList.addItems([' '.join(student[1:]) 
+                                   for student in students])
+        if self.studentList.currentRow() < 0 and self.students:
+            self.studentList.setCurrentRow(0)
+
+        # Changes made while streaming are caught up from this version
+        self.studentVersion = batch['version']
+        self.studentEpoch = batch['epoch']
+
+
+    def FailRefresh(self):
+        """
+        Give up on a failed refresh, so the next one reloads every student.
+        """
+
+        self.studentVersion = None
+        self.FinishRefresh()
+
+
+    def FinishRefresh(self):
+        """
+        Clear the loading indicator and run any refresh requested meanwhile.
+        """
+
+        self.refreshPending = False
+        self.ShowLoading(False)
+        if self.refreshQueued:
+            self.refreshQueued = False
+            self.UpdateStudentList()
+
+        
+    def ApplyPushedEvent(self, event):
+        """
+        Patch in changes pushed by the server. Runs on the GUI thread.
+
+        Events that do not follow on from the displayed version, or that ask
+        for a reset, are caught up with UpdateStudentList instead.
+
+        INPUT:
+          event - Dictionary described in Logic.Subscription
+        """
+
+        following = (event['epoch'] == self.studentEpoch and 
+                     event['since'] == self.studentVersion)
+        if following and not self.refreshPending and 'changes' in event:
+            for change in event['changes']:
+                self.ApplyStudentChange(*change[1:])
+            self.studentVersion = event['version']
+        elif (event['epoch'] != self.studentEpoch or 
+              event['version'] != self.studentVersion):
+            self.UpdateStudentList()
+
+        
+    def ResetStudentList(self, students):
+        """
+        Replace the displayed students.
+
+        INPUT:
+          students - List of (ID, first name, last name) ordered by ID
+        """
+
+        self.students = list(students)
+        self.studentIDs = [student[0] for student in self.students]
 
         # Display student list and select first student
         self.studentList.clear()
-        self.studentList.addItems(students)
+        self.studentList.addItems([' '.join(student[1:]) 
+                                   for student in self.students])
         self.studentList.setCurrentRow(0)
 
         
+    def ApplyStudentChange(self, op, id, firstName, lastName):
+        """
+        Patch a single changed student into the displayed list.
+
+        INPUT:
+          op        - 'insert', 'update' or 'delete'
+          id        - Student's ID number in database
+          firstName - Student's first name (None for a delete)
+          lastName  - Student's last name (None for a delete)
+        """
+
+        row = bisect.bisect_left(self.studentIDs, id)
+        found = row < len(self.studentIDs) and self.studentIDs[row] == id
+
+        if op == 'delete':
+            if found:
+                del self.students[row]
+                del self.studentIDs[row]
+                self.studentList.takeItem(row)
+        elif found:
+            self.students[row] = (id, firstName, lastName)
+            self.studentList.item(row).setText(' '.join([firstName, 
+                                                         lastName]))
+        else:
+            self.students.insert(row, (id, firstName, lastName))
+            self.studentIDs.insert(row, id)
+            self.studentList.insertItem(row, ' '.join([firstName, lastName]))
+
+        if self.studentList.currentRow() < 0 and self.students:
+            self.studentList.setCurrentRow(0)
+
+        
     def CreateAddWindow(self):
         """
         Create a pop-up window for adding a new student.
@@ -242,11 +433,9 @@ class MainUI(QtWidgets.QMainWindow):
         self.miniWindow.resize(500,250)
         self.PositionWindow(self.miniWindow)
 
-        # Get Selected student name and ID from DataFrame
+        # Get Selected student name and ID
         selectedRow = self.studentList.currentRow()
-        self.selectedID = int(self.studentDF.loc[selectedRow, 'ID'])
-        firstName = self.studentDF.loc[selectedRow, 'First Name']
-        lastName = self.studentDF.loc[selectedRow, 'Last Name']
+        self.selectedID, firstName, lastName = self.students[selectedRow]
         
         # Labels
         firstNameLabel = QtWidgets.QLabel('First Name')
@@ -319,11 +508,10 @@ class MainUI(QtWidgets.QMainWindow):
         self.miniWindow.resize(500,250)
         self.PositionWindow(self.miniWindow)
 
-        # Get Selected student name and ID from DataFrame
+        # Get Selected student name and ID
         selectedRow = self.studentList.currentRow()
-        self.selectedID = int(self.studentDF.loc[selectedRow, 'ID'])
-        studentName = ' '.join([self.studentDF.loc[selectedRow, 'First Name'],
-                                self.studentDF.loc[selectedRow, 'Last Name']])
+        self.selectedID = self.students[selectedRow][0]
+        studentName = ' '.join(self.students[selectedRow][1:])
 
         # Labels
         textLabel = QtWidgets.QLabel('Delete %s from database?' % studentName)
@@ -362,19 +550,13 @@ class MainUI(QtWidgets.QMainWindow):
         """
         Send message to server to add student to the database.
 
-        Message sent as a little-endian message indicating buffer size followed 
-        by a pickled dictionary containing instructions and student information.
+        The server handles a connection's requests in order, so the refresh 
+        sent right after it already sees the new student.
         """
         
         firstName = self.firstNameText.text()
         lastName = self.lastNameText.text()
-        msgdict = {'cmd':'AddStudent',
-                   'data':{'values':{'first_name':firstName,
-                                     'last_name':lastName}}}
-        sendmsg = pickle.dumps(msgdict)
-        sizemsg = struct.pack('<i',len(sendmsg))
-        self.sock.sendall(sizemsg)
-        self.sock.sendall(sendmsg)
+        self.SendRequest(self.client.AddStudent(firstName, lastName))
 
         self.UpdateStudentList()
         self.miniWindow.close()
@@ -383,17 +565,9 @@ class MainUI(QtWidgets.QMainWindow):
     def DeleteStudent(self):
         """
         Send message to server to delete a student from the database.
-
-        Message sent as a little-endian message indicating buffer size followed 
-        by a pickled dictionary containing instructions and student information.
         """
         
-        msgdict = {'cmd':'DeleteStudent',
-                   'data':{'ID':self.selectedID}}
-        sendmsg = pickle.dumps(msgdict)
-        sizemsg = struct.pack('<i',len(sendmsg))
-        self.sock.sendall(sizemsg)
-        self.sock.sendall(sendmsg)
+        self.SendRequest(self.client.DeleteStudent(self.selectedID))
 
         self.UpdateStudentList()
         self.miniWindow.close()
@@ -402,21 +576,12 @@ class MainUI(QtWidgets.QMainWindow):
     def UpdateStudent(self):
         """
         Send message to server to update a student in the database.
-
-        Message sent as a little-endian message indicating buffer size followed 
-        by a pickled dictionary containing instructions and student information.
         """
         
         firstName = self.firstNameText.text()
         lastName = self.lastNameText.text()
-        msgdict = {'cmd':'UpdateStudent',
-                   'data':{'ID':self.selectedID,
-                           'values':{'first_name':firstName,
-                                     'last_name':lastName}}}
-        sendmsg = pickle.dumps(msgdict)
-        sizemsg = struct.pack('<i',len(sendmsg))
-        self.sock.sendall(sizemsg)
-        self.sock.sendall(sendmsg)
+        self.SendRequest(self.client.UpdateStudent(self.selectedID, firstName,
+                                                   lastName))
 
         self.UpdateStudentList()
         self.miniWindow.close()
@@ -440,15 +605,11 @@ class MainUI(QtWidgets.QMainWindow):
     def CleanupFunction(self):
         """
         Send message to server to close connection when program exits.
-
-        Message sent as a little-endian message indicating buffer size followed 
-        by a pickled dictionary containing instructions and student information.
         """
-        msgdict = {'cmd':'CloseSocket'}
-        sendmsg = pickle.dumps(msgdict)
-        sizemsg = struct.pack('<i',len(sendmsg))
-        self.sock.sendall(sizemsg)
-        self.sock.sendall(sendmsg)
+
+        if self.client is not None:
+            self.client.Close()
+            self.client = None
         
 
 if __name__ == '__main__':
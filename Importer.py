@@ -0,0 +1,150 @@
+import sys
+import csv
+import json
+import time
+import sqlite3
+import argparse
+import itertools
+
+import Logic
+
+
+# Accepted names for the first and last name fields, as written by
+# ExportStudents or matching the table's columns
+FIRST_NAME_FIELDS = ('First Name', 'first_name')
+LAST_NAME_FIELDS = ('Last Name', 'last_name')
+
+
+def _Field(record, fields):
+    for field in fields:
+        if field in record:
+            return record[field]
+    return None
+
+
+def ReadRecords(path, fmt=None, offset=0):
+    """
+    Generate the records of a CSV or JSON lines file one at a time.
+
+    INPUT:
+      path   - File to read
+      fmt    - 'csv' or 'jsonl' (default: from the file extension)
+      offset - Number of records to skip, e.g. those already imported
+
+    OUTPUT:
+      (record number, dictionary) tuples, numbered from 0 after any CSV
+      header
+    """
+
+    if fmt is None:
+        fmt = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+    if fmt not in ('csv', 'jsonl'):
+        raise ValueError('Unknown import format %r' % fmt)
+
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        yield from itertools.islice(enumerate(records), offset, None)
+
+
+def ValidateChunk(chunk):
+    """
+    Check a chunk of records and return their names.
+
+    INPUT:
+      chunk - List of (record number, dictionary) tuples from ReadRecords
+
+    OUTPUT:
+      names - List of (first name, last name) tuples
+    """
+
+    names = []
+    for number, record in chunk:
+        if not isinstance(record, dict):
+            raise ValueError('Record %d is not an object' % number)
+        firstName = _Field(record, FIRST_NAME_FIELDS)
+        lastName = _Field(record, LAST_NAME_FIELDS)
+        if not isinstance(firstName, str) or not firstName.strip():
+            raise ValueError('Record %d has no first name' % number)
+        if not isinstance(lastName, str) or not lastName.strip():
+            raise ValueError('Record %d has no last name' % number)
+        names.append((firstName, lastName))
+    return names
+
+
+def ImportFile(logic, path, fmt=None, chunkSize=10000, offset=0,
+               OnProgress=None):
+    """
+    Stream a file of students into the database.
+
+    Records are read, validated and inserted a chunk at a time, each chunk in
+    its own transaction, so memory use does not grow with the file. If a
+    chunk fails, every earlier chunk stays committed and the import can be
+    resumed by passing the last offset reported to OnProgress. IDs in the
+    file are ignored; students get new IDs.
+
+    INPUT:
+      logic      - LogicLayer to import into
+      path       - CSV or JSON lines file (see ReadRecords)
+      fmt        - 'csv' or 'jsonl' (default: from the file extension)
+      chunkSize  - Records per transaction
+      offset     - Number of records to skip
+      OnProgress - Function called with the number of records done,
+                   including the skipped ones, after each chunk commits
+
+    OUTPUT:
+      count - Number of students added
+    """
+
+    if chunkSize <= 0:
+        raise ValueError('chunkSize must be positive')
+
+    count = 0
+    records = ReadRecords(path, fmt, offset)
+    while True:
+        chunk = list(itertools.islice(records, chunkSize))
+        if not chunk:
+            return count
+        count += logic.ImportStudents(ValidateChunk(chunk))
+        if OnProgress is not None:
+            OnProgress(offset + count)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Import students from a CSV or JSON lines file')
+    parser.add_argument('path', help='File to import')
+    parser.add_argument('--db', default='students.db',
+                        help='Path to database')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='File format (default: from the extension)')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='Records per transaction')
+    parser.add_argument('--offset', type=int, default=0,
+                        help='Records to skip, to resume an import')
+    args = parser.parse_args()
+
+    logic = Logic.LogicLayer(args.db)
+    start = time.perf_counter()
+    done = args.offset
+
+    def ReportProgress(records):
+        global done
+        done = records
+        elapsed = time.perf_counter() - start
+        print('%d records imported (%.0f/s)'
+              % (done, (done - args.offset) / max(elapsed, 1e-9)),
+              file=sys.stderr)
+
+    try:
+        ImportFile(logic, args.path, args.format, args.chunk_size,
+                   args.offset, ReportProgress)
+    except (ValueError, OSError, sqlite3.Error) as e:
+        print('Import stopped: %s' % e, file=sys.stderr)
+        print('Resume with --offset %d' % done, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        logic.Close()
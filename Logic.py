@@ -1,8 +1,676 @@
+import io
+import sys
+import csv
 import socket
 import sqlite3
 import pickle
-import struct
-import pandas as pd
+import asyncio
+import argparse
+import itertools
+import threading
+import time
+import uuid
+import heapq
+import bisect
+import queue
+import pathlib
+import contextlib
+import multiprocessing
+import json
+
+import Protocol
+
+from operator import itemgetter
+from collections import deque, OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+
+# Schema changes applied on top of the table created by CreateDB.py, in 
+# order. PRAGMA user_version records how many have already been applied.
+SCHEMA_MIGRATIONS = [
+    '''CREATE INDEX IF NOT EXISTS students_last_first 
+       ON students (last_name, first_name)''',
+    '''CREATE INDEX IF NOT EXISTS students_first_last 
+       ON students (first_name, last_name)''',
+]
+
+# Column names of student tables returned by LogicLayer
+STUDENT_COLUMNS = ['ID', 'First Name', 'Last Name']
+
+# Position of each column in the rows returned by LogicLayer queries
+STUDENT_FIELDS = {'id':0, 'first_name':1, 'last_name':2}
+
+# Table created in empty shards of a ShardedLogicLayer, as by CreateDB.py
+SHARD_TABLE = '''CREATE TABLE IF NOT EXISTS students (
+                   id INTEGER PRIMARY KEY, first_name TEXT NOT NULL,
+                   last_name TEXT NOT NULL)'''
+
+# Where a shard sits in its ShardedLogicLayer, as a single row, so it is 
+# never opened with a layout that would route its students elsewhere
+SHARD_LAYOUT_TABLE = '''CREATE TABLE IF NOT EXISTS shard_layout (
+                          shard INTEGER NOT NULL, shards INTEGER NOT NULL,
+                          partition TEXT NOT NULL, range_size INTEGER)'''
+
+# ORDER BY clauses for the sort orders accepted by SearchStudents. Each ends 
+# with the ID so the order is total, and matches one of the indexes above.
+SORT_ORDERS = {'id':('id',),
+               'last_name':('last_name', 'first_name', 'id'),
+               'first_name':('first_name', 'last_name', 'id')}
+
+# Storage settings applied to every connection LogicLayer opens, by profile
+# name. 'default' keeps SQLite's own settings. Negative cache sizes are in
+# KiB; mmap_size is in bytes.
+TUNING_PROFILES = {
+    'default':{},
+    'durable':{'journal_mode':'wal', 'synchronous':'full',
+               'cache_size':-8192, 'mmap_size':0, 'temp_store':'default'},
+    'balanced':{'journal_mode':'wal', 'synchronous':'normal',
+                'cache_size':-65536, 'mmap_size':256 * 2**20,
+                'temp_store':'memory'},
+    'read-heavy':{'journal_mode':'wal', 'synchronous':'normal',
+                  'cache_size':-262144, 'mmap_size':2**30,
+                  'temp_store':'memory'},
+}
+
+# Settings a read-only connection can change, as they only last as long as
+# the connection
+CONNECTION_SETTINGS = ('cache_size', 'mmap_size', 'temp_store')
+STORAGE_SETTINGS = ('journal_mode', 'synchronous') + CONNECTION_SETTINGS
+
+# Names for the numbers SQLite reports some settings as
+SYNCHRONOUS_NAMES = ['off', 'normal', 'full', 'extra']
+TEMP_STORE_NAMES = ['default', 'file', 'memory']
+
+
+def ApplyProfile(conn, profile, settings=STORAGE_SETTINGS):
+    """
+    Apply a storage tuning profile to a connection.
+
+    INPUT:
+      conn     - sqlite3 connection, outside any transaction
+      profile  - Name of a profile in TUNING_PROFILES
+      settings - Which of the profile's settings to apply
+    """
+
+    if profile not in TUNING_PROFILES:
+        raise ValueError('Unknown tuning profile %r' % profile)
+
+    for name in settings:
+        value = TUNING_PROFILES[profile].get(name)
+        if value is not None:
+            conn.execute('PRAGMA %s = %s' % (name, value)).fetchall()
+
+
+def StorageSettings(conn):
+    """
+    Return the storage settings in effect on a connection, as a dictionary.
+    """
+
+    settings = {}
+    for name in STORAGE_SETTINGS:
+        row = conn.execute('PRAGMA %s' % name).fetchone()
+        settings[name] = row[0] if row is not None else None
+    settings['synchronous'] = SYNCHRONOUS_NAMES[settings['synchronous']]
+    settings['temp_store'] = TEMP_STORE_NAMES[settings['temp_store']]
+    return settings
+
+
+class ClientSession:
+    """
+    A connected client, as seen by LogicLayer.ProcessMessage.
+
+    INPUT:
+      sock - Connected socket for the client
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+        # Replies and pushed change events are sent from different threads
+        self.sendLock = threading.Lock()
+
+        # Replies at least this large are compressed, once the client has
+        # agreed to it (see LogicLayer.Negotiate)
+        self.compressAbove = None
+
+    def sendall(self, data):
+        with self.sendLock:
+            self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+
+class AsyncClientSession(ClientSession):
+    """
+    A client connected to the asyncio server.
+
+    Replies are produced on executor threads, so writes are handed back to the
+    event loop and the calling thread waits until the transport has drained.
+
+    INPUT:
+      loop   - Event loop running the server
+      writer - asyncio.StreamWriter for the client
+    """
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.compressAbove = None
+
+    async def _Write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def sendall(self, data):
+        future = asyncio.run_coroutine_threadsafe(self._Write(bytes(data)),
+                                                  self.loop)
+        future.result()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class ReplyCache:
+    """
+    Bounded cache of serialized replies, evicting the least recently used.
+
+    INPUT:
+      maxEntries - Number of replies kept (0 disables caching)
+    """
+
+    def __init__(self, maxEntries=128):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def Get(self, key):
+        """
+        Return the reply stored under key, or None.
+        """
+
+        with self.lock:
+            reply = self.entries.get(key)
+            if reply is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            return reply
+
+    def Put(self, key, reply):
+        """
+        Store a reply, evicting the least recently used one if full.
+        """
+
+        with self.lock:
+            if self.maxEntries <= 0:
+                return
+            self.entries[key] = reply
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def Clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def Stats(self):
+        """
+        Return the hit and miss counts and current size.
+        """
+
+        with self.lock:
+            return {'hits':self.hits, 'misses':self.misses,
+                    'entries':len(self.entries), 
+                    'maxEntries':self.maxEntries}
+
+
+class ReaderPool:
+    """
+    Fixed set of read-only connections shared by worker threads.
+
+    With the database in WAL mode each reader sees a consistent snapshot and
+    neither waits for the writer nor holds it up, so reads run in parallel.
+
+    INPUT:
+      dbName  - Path to database file
+      size    - Number of connections
+      profile - Tuning profile for each connection (see TUNING_PROFILES)
+    """
+
+    def __init__(self, dbName, size, profile='default'):
+        uri = pathlib.Path(dbName).resolve().as_uri() + '?mode=ro'
+        self.size = size
+        self.connections = queue.Queue()
+        for i in range(size):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            ApplyProfile(conn, profile, CONNECTION_SETTINGS)
+            self.connections.put(conn)
+
+        self.lock = threading.Lock()
+        self.acquisitions = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    @contextlib.contextmanager
+    def Connection(self):
+        """
+        Borrow a connection for the duration of a with block.
+        """
+
+        start = time.perf_counter()
+        conn = self.connections.get()
+        wait = time.perf_counter() - start
+        with self.lock:
+            self.acquisitions += 1
+            self.totalWait += wait
+            self.maxWait = max(self.maxWait, wait)
+
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def Stats(self):
+        """
+        Return the pool size and how long readers waited for a connection.
+        """
+
+        with self.lock:
+            return {'size':self.size, 'acquisitions':self.acquisitions,
+                    'totalWait':self.totalWait, 'maxWait':self.maxWait,
+                    'averageWait':self.totalWait / max(self.acquisitions, 1)}
+
+    def Close(self):
+        for i in range(self.size):
+            self.connections.get().close()
+
+
+class GroupCommitter:
+    """
+    Commits writes from many threads together in shared transactions.
+
+    A background thread takes the first queued write, waits up to window 
+    seconds for more (at most maxWrites in all), runs each inside its own 
+    savepoint and commits them with a single fsync. Submit only returns once
+    the write's group is committed.
+
+    INPUT:
+      logic     - LogicLayer whose connection is written to
+      window    - Seconds to wait for more writes to join a group
+      maxWrites - Most writes committed in one group
+    """
+
+    def __init__(self, logic, window=0.002, maxWrites=64):
+        self.logic = logic
+        self.window = window
+        self.maxWrites = maxWrites
+        self.commits = 0
+        self.writes = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._Run, daemon=True)
+        self.thread.start()
+
+    def Submit(self, Apply):
+        """
+        Queue a write (see LogicLayer._Write) and wait for it to be durable.
+        """
+
+        future = Future()
+        self.queue.put((Apply, future))
+        return future.result()
+
+    def Stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def Stats(self):
+        """
+        Return how many groups were committed and how many writes they held.
+        """
+
+        with self.logic.dbLock:
+            return {'commits':self.commits, 'writes':self.writes,
+                    'averageGroupSize':self.writes / max(self.commits, 1),
+                    'window':self.window, 'maxWrites':self.maxWrites}
+
+    def _Run(self):
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            group = [item]
+            deadline = time.monotonic() + self.window
+            while len(group) < self.maxWrites:
+                try:
+                    item = self.queue.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                group.append(item)
+
+            self._CommitGroup(group)
+
+    def _CommitGroup(self, group):
+        logic = self.logic
+        outcomes = []
+        changes = []
+
+        with logic.dbLock:
+            try:
+                logic.cursor.execute('BEGIN')
+                for Apply, future in group:
+                    # A failing write only undoes itself, not the whole group
+                    logic.cursor.execute('SAVEPOINT groupwrite')
+                    try:
+                        result, writeChanges = Apply()
+                    except Exception as e:
+                        logic.cursor.execute('ROLLBACK TO groupwrite')
+                        outcomes.append((future, None, e))
+                    else:
+                        changes += writeChanges
+                        outcomes.append((future, result, None))
+                    logic.cursor.execute('RELEASE groupwrite')
+                logic.conn.commit()
+            except Exception as e:
+                logic.conn.rollback()
+                for Apply, future in group:
+                    future.set_exception(e)
+                return
+
+            logic._RecordChanges(changes)
+            self.commits += 1
+            self.writes += len(group)
+
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+class Subscription:
+    """
+    A client's subscription to change events, with its own sender thread.
+
+    Writers only record each committed change against the student's ID, so a
+    newer change to a student replaces one not sent yet and no commit ever 
+    waits on the client. The thread sends everything recorded as a single 
+    event. If more than maxPending students have changes waiting, they are 
+    dropped and the client is told to reload instead.
+
+    Events are pickled dictionaries tagged with the Subscribe request's ID,
+    holding the 'epoch', the 'version' they bring the client to and the 
+    version they start from ('since'), and either 'changes', a list of
+    (version, operation, ID, first name, last name) tuples, or 'reset': True.
+    The first event has no changes and gives the version subscribed at.
+    Once unsubscribed, an empty message ends the stream.
+
+    INPUT:
+      logic      - LogicLayer the subscription belongs to
+      session    - Client to send events to
+      reqID      - ID of the Subscribe request
+      maxPending - Most students with changes waiting before a reset
+    """
+
+    def __init__(self, logic, session, reqID, maxPending=1000):
+        self.logic = logic
+        self.session = session
+        self.reqID = reqID
+        self.maxPending = maxPending
+
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()
+        self.reset = False
+        self.closed = False
+        self.started = False
+        self.since = logic.version
+        self.version = logic.version
+
+        self.thread = threading.Thread(target=self._Run, daemon=True)
+        self.thread.start()
+
+    def Publish(self, changes):
+        """
+        Record committed changes from the change log (see _RecordChanges).
+        """
+
+        with self.condition:
+            for change in changes:
+                version, op, id = change[:3]
+                self.version = version
+                if op == 'reset':
+                    self.reset = True
+                    self.pending.clear()
+                elif not self.reset:
+                    self.pending.pop(id, None)
+                    self.pending[id] = change
+
+            if len(self.pending) > self.maxPending:
+                self.reset = True
+                self.pending.clear()
+            self.condition.notify()
+
+    def Close(self):
+        """
+        Stop sending events, ending the stream with an empty message.
+        """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def _Run(self):
+        while True:
+            with self.condition:
+                while not (self.closed or self.reset or self.pending or 
+                           not self.started):
+                    self.condition.wait()
+                if self.closed:
+                    break
+
+                event = {'epoch':self.logic.epoch, 'since':self.since}
+                if not self.started:
+                    event['version'] = self.since
+                    event['changes'] = []
+                    self.started = True
+                else:
+                    event['version'] = self.version
+                    if self.reset:
+                        event['reset'] = True
+                    else:
+                        event['changes'] = list(self.pending.values())
+                    self.since = self.version
+                    self.pending.clear()
+                    self.reset = False
+
+            if not self._Send(pickle.dumps(event)):
+                self.logic.Unsubscribe(self.session, self)
+                return
+
+        self._Send(b'')
+
+    def _Send(self, payload):
+        try:
+            self.logic._Send(self.session, payload, self.reqID)
+        except (OSError, RuntimeError):
+            # The client is gone, or the event loop serving it has stopped
+            return False
+        return True
+
+
+# Upper bounds in seconds of the latency histogram buckets. Anything slower
+# than the last bound falls in a final overflow bucket.
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class LatencyHistogram:
+    """
+    Count of durations in fixed buckets, with their total and maximum.
+    Not thread safe; ServerMetrics serializes access.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def Record(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def Percentile(self, p):
+        """
+        Return the upper bound of the bucket holding the p-th percentile, or
+        the maximum if that is in the overflow bucket.
+        """
+
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def Stats(self):
+        return {'count':self.count, 'total':self.total, 'max':self.max,
+                'mean':self.total / max(self.count, 1),
+                'p50':self.Percentile(50), 'p95':self.Percentile(95),
+                'p99':self.Percentile(99),
+                'buckets':list(zip(LATENCY_BUCKETS + [None], self.counts))}
+
+
+class ServerMetrics:
+    """
+    Per-command request counts and latencies, and connection and byte totals.
+
+    Each command's time is recorded in total and split into phases: 'db' for
+    running SQL and waiting for commits, 'serialize' for decoding the request
+    and encoding the reply, 'compress' for compressing it and 'send' for 
+    writing it to the client. Compressed replies are also totalled before 
+    and after compression.
+    Phases are timed with Phase blocks anywhere below ProcessMessage, and are
+    charged to the request being processed on the current thread.
+    """
+
+    PHASES = ('db', 'serialize', 'compress', 'send')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.commands = {}
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.activeConnections = 0
+        self.connections = 0
+        self.compressedReplies = 0
+        self.compressedBytesIn = 0
+        self.compressedBytesOut = 0
+
+    @contextlib.contextmanager
+    def Phase(self, name):
+        """
+        Charge the time spent in a with block to a phase of the current 
+        request.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phases = getattr(self.local, 'phases', None)
+            if phases is not None:
+                phases[name] = (phases.get(name, 0.0) + 
+                                time.perf_counter() - start)
+
+    def BeginRequest(self):
+        self.local.phases = {}
+
+    def EndRequest(self, cmd, start, bytesIn, failed=False):
+        """
+        Record a finished request.
+
+        INPUT:
+          cmd     - Command name
+          start   - time.perf_counter() when the request started
+          bytesIn - Size of the request on the wire
+          failed  - Whether the request raised an exception
+        """
+
+        total = time.perf_counter() - start
+        phases = self.local.phases
+        self.local.phases = None
+
+        with self.lock:
+            stats = self.commands.get(cmd)
+            if stats is None:
+                stats = {'errors':0, 'total':LatencyHistogram()}
+                for phase in self.PHASES:
+                    stats[phase] = LatencyHistogram()
+                self.commands[cmd] = stats
+
+            stats['errors'] += failed
+            stats['total'].Record(total)
+            for phase in self.PHASES:
+                stats[phase].Record(phases.get(phase, 0.0))
+            self.bytesIn += bytesIn
+
+    def Sent(self, size):
+        with self.lock:
+            self.bytesOut += size
+
+    def Compressed(self, size, compressedSize):
+        with self.lock:
+            self.compressedReplies += 1
+            self.compressedBytesIn += size
+            self.compressedBytesOut += compressedSize
+
+    def Connected(self):
+        with self.lock:
+            self.activeConnections += 1
+            self.connections += 1
+
+    def Disconnected(self):
+        with self.lock:
+            self.activeConnections -= 1
+
+    def Stats(self):
+        """
+        Return every figure as a dictionary of plain values.
+        """
+
+        with self.lock:
+            commands = {}
+            for cmd, stats in self.commands.items():
+                commands[cmd] = {'count':stats['total'].count,
+                                 'errors':stats['errors']}
+                for name in ('total',) + self.PHASES:
+                    commands[cmd][name] = stats[name].Stats()
+
+            return {'uptime':time.time() - self.started,
+                    'bytesIn':self.bytesIn, 'bytesOut':self.bytesOut,
+                    'activeConnections':self.activeConnections,
+                    'connections':self.connections, 'commands':commands,
+                    'compression':{
+                        'replies':self.compressedReplies,
+                        'bytesBefore':self.compressedBytesIn,
+                        'bytesAfter':self.compressedBytesOut,
+                        'ratio':(self.compressedBytesOut / 
+                                 max(self.compressedBytesIn, 1))}}
 
 
 class LogicLayer:
@@ -10,21 +678,236 @@ class LogicLayer:
     Class containing logic for interacting with the database.
     
     INPUT:
-      dbName - Path to database (string)
+      dbName        - Path to database (string)
+      changeLogSize - Number of row-level changes kept for GetStudentsSince
+      cacheSize     - Number of serialized query replies cached
+      durability    - 'default' to commit each write in rollback-journal
+                      mode, 'wal' to commit each write in WAL mode, or 
+                      'group' to use WAL and commit concurrent writes together
+      commitWindow  - Seconds a group commit waits for more writes to join
+      maxGroupSize  - Most writes in one group commit
+      readPoolSize  - Number of read-only connections serving queries in 
+                      parallel, in WAL mode (0 to share one connection)
+      statsLog      - File to append GetStats figures to as JSON lines
+                      (None to not log them)
+      statsInterval - Seconds between lines in statsLog
+      compressAbove - Size in bytes from which replies are zlib-compressed
+                      for clients that negotiate it (None to not offer 
+                      compression)
+      maxPendingEvents - Most students with changes waiting to be pushed 
+                         to a subscriber before it is told to reload
+      replica       - Serve queries from an in-memory copy of the database,
+                      kept current by applying each committed change
+      profile       - Storage tuning profile (see TUNING_PROFILES). The 
+                      durability modes other than 'default' override its
+                      journal_mode and synchronous settings.
     """
 
     
-    def __init__(self, dbName='students.db'):
+    def __init__(self, dbName='students.db', changeLogSize=10000,
+                 cacheSize=128, durability='default', commitWindow=0.002,
+                 maxGroupSize=64, readPoolSize=0, statsLog=None,
+                 statsInterval=60.0, compressAbove=16384,
+                 maxPendingEvents=1000, replica=False, profile='default'):
         """
         Create a connection object and cursor for the specified database file 
         (default students.db)
         """
         
-        self.conn = sqlite3.connect(dbName)
+        self.dbName = dbName
+        self.conn = sqlite3.connect(dbName, check_same_thread=False)
         self.cursor = self.conn.cursor()
         self.colNames = '(first_name, last_name)'
+        self.profile = profile
+        ApplyProfile(self.conn, profile)
+
+        # Serializes use of the shared connection when serving many clients
+        self.dbLock = threading.RLock()
+
+        # Every committed change to a student gets the next version number.
+        # The epoch identifies this run so versions from a previous server
+        # are never mistaken for current ones.
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self.changeLog = deque(maxlen=changeLogSize)
+
+        # Replies to read-only queries, keyed by version and query, so any 
+        # committed change makes every cached reply stale
+        self.replyCache = ReplyCache(cacheSize)
+        self.metrics = ServerMetrics()
+        self.compressAbove = compressAbove
+
+        # Subscriptions to change events, guarded by dbLock
+        self.subscriptions = []
+        self.maxPendingEvents = maxPendingEvents
+
+        self.MigrateSchema()
+
+        if durability not in ('default', 'wal', 'group'):
+            raise ValueError('Unknown durability mode %r' % durability)
+        if durability != 'default':
+            # A commit in WAL mode is only durable once synced with FULL
+            self.cursor.execute('PRAGMA journal_mode = WAL')
+            self.cursor.execute('PRAGMA synchronous = FULL')
+
+        if replica and readPoolSize > 0:
+            raise ValueError('Use either a replica or a reader pool')
+
+        # With a replica, queries never touch the disk and never wait for 
+        # dbLock, only for a writer applying its changes to the replica
+        self.replica = None
+        self.replicaLock = threading.Lock()
+        self.replicaRefreshes = 0
+        self.replicaChanges = 0
+        if replica:
+            self.replica = sqlite3.connect(':memory:', 
+                                           check_same_thread=False)
+            self.RefreshReplica()
+
+        # With a reader pool, self.conn is left to writes alone
+        self.readerPool = None
+        if readPoolSize > 0:
+            if dbName == ':memory:':
+                raise ValueError('A reader pool needs a database file')
+            self.cursor.execute('PRAGMA journal_mode = WAL')
+            self.readerPool = ReaderPool(dbName, readPoolSize, profile)
+
+        # What the profile and durability mode came to on this database
+        self.storageSettings = StorageSettings(self.conn)
+
+        self.groupCommitter = None
+        if durability == 'group':
+            self.groupCommitter = GroupCommitter(self, commitWindow, 
+                                                 maxGroupSize)
+
+        self.loop = None
+        self.asyncServer = None
+        self.serverAddress = None
+        self.serverReady = threading.Event()
+
+        self.statsLogStop = threading.Event()
+        self.statsLogThread = None
+        if statsLog is not None:
+            self.statsLogThread = threading.Thread(
+                target=self._LogStats, args=(statsLog, statsInterval),
+                daemon=True)
+            self.statsLogThread.start()
 
         
+    def Close(self):
+        """
+        Stop background work and close the database connection.
+        """
+
+        if self.statsLogThread is not None:
+            self.statsLogStop.set()
+            self.statsLogThread.join()
+            self.statsLogThread = None
+        if self.groupCommitter is not None:
+            self.groupCommitter.Stop()
+            self.groupCommitter = None
+        if self.readerPool is not None:
+            self.readerPool.Close()
+            self.readerPool = None
+        if self.replica is not None:
+            self.replica.close()
+            self.replica = None
+        self.conn.close()
+
+
+    def _LogStats(self, statsLog, statsInterval):
+        """
+        Append the GetStats figures to a file every statsInterval seconds, 
+        and once more on Close.
+        """
+
+        stopping = False
+        while not stopping:
+            stopping = self.statsLogStop.wait(statsInterval)
+            line = dict(self.GetStats(), time=time.time())
+            with open(statsLog, 'a') as f:
+                f.write(json.dumps(line) + '\n')
+
+
+    def Negotiate(self, session, offer):
+        """
+        Agree with a client on optional protocol features. Clients send a
+        Negotiate message right after the hello handshake; clients that do 
+        not get none of the features.
+
+        INPUT:
+          session - Client the features are agreed with
+          offer   - Dictionary of features the client supports: 
+                    'compression' is a list of compression methods
+
+        OUTPUT:
+          agreed - Dictionary with the 'compression' method to use (None or 
+                   'zlib') and 'compressAbove', the size from which either
+                   side compresses messages
+        """
+
+        agreed = {'compression':None, 'compressAbove':None}
+        if (self.compressAbove is not None and 
+                'zlib' in offer.get('compression', ())):
+            agreed = {'compression':'zlib', 
+                      'compressAbove':self.compressAbove}
+        session.compressAbove = agreed['compressAbove']
+        return agreed
+
+
+    def GetStats(self):
+        """
+        Return server metrics along with reply cache, reader pool and group
+        commit statistics.
+
+        OUTPUT:
+          stats - Dictionary of ServerMetrics.Stats figures plus 'cache', 
+                  'pool' and 'groupCommit' (None when not in use)
+        """
+
+        stats = self.metrics.Stats()
+        stats['cache'] = self.replyCache.Stats()
+        stats['pool'] = None
+        if self.readerPool is not None:
+            stats['pool'] = self.readerPool.Stats()
+        stats['groupCommit'] = None
+        if self.groupCommitter is not None:
+            stats['groupCommit'] = self.groupCommitter.Stats()
+        stats['storage'] = dict(self.storageSettings, profile=self.profile)
+        stats['replica'] = None
+        if self.replica is not None:
+            stats['replica'] = {'refreshes':self.replicaRefreshes,
+                                'changes':self.replicaChanges}
+        return stats
+
+
+    def MigrateSchema(self, conn=None):
+        """
+        Apply any schema migrations the database does not have yet.
+
+        INPUT:
+          conn - Connection to the database (default: self.conn)
+        """
+
+        if conn is None:
+            conn = self.conn
+
+        with self.dbLock:
+            cursor = conn.cursor()
+            cursor.execute('''SELECT count(*) FROM sqlite_master 
+                              WHERE type = 'table' AND name = 'students'
+                           ''')
+            if cursor.fetchone()[0] == 0:
+                return
+
+            cursor.execute('PRAGMA user_version')
+            applied = cursor.fetchone()[0]
+            for version in range(applied, len(SCHEMA_MIGRATIONS)):
+                cursor.execute(SCHEMA_MIGRATIONS[version])
+                cursor.execute('PRAGMA user_version = %d' % (version + 1))
+            conn.commit()
+
+
     def ConnectUI(self, TCP_IP='127.0.0.1', TCP_PORT=5005):
         """
         Create socket and wait for connection from UI.
@@ -44,6 +927,8 @@ class LogicLayer:
         self.serverSock.bind((TCP_IP, TCP_PORT))
         self.serverSock.listen(1)
         self.clientSock, addr = self.serverSock.accept()
+        self.session = ClientSession(self.clientSock)
+        self.metrics.Connected()
 
         # Look for the initial hello message
         data = self.clientSock.recv(len(clientInitMsg))
@@ -56,64 +941,492 @@ class LogicLayer:
                 print('Error sending data')
 
     def WaitForMessages(self):
-        buffSize = 4
         
         # Continue looking for messages from client
         connectionOpen = True
         while connectionOpen:
-            buff = self.clientSock.recv(buffSize)
-            if buff is not None:
-                msgSize = struct.unpack('<i', buff)[0]
-                buff = self.clientSock.recv(msgSize)
-                connectionOpen = self.ProcessMessage(buff)
-                
+            buff = Protocol.ReceiveMessage(self.clientSock)
+            if buff is None:
+                break
+            connectionOpen = self.ProcessMessage(buff)
+        self.Unsubscribe(self.session)
+        self.metrics.Disconnected()
 
-    def ProcessMessage(self, msg_orig):
+
+    def ServeAsync(self, TCP_IP='127.0.0.1', TCP_PORT=5005, maxWorkers=4):
         """
-        Process instructions from UI.
+        Serve any number of UI clients at once using asyncio.
+
+        Each connection performs the same handshake as ConnectUI and sends 
+        the same length-prefixed messages as WaitForMessages expects. Commands
+        run on a bounded pool of worker threads so a slow client only ties up
+        its own worker. Blocks until StopServer is called.
 
         INPUT:
-          msg_orig - Pickled dictionary containing command information
+          TCP_IP     - IP address
+          TCP_PORT   - Port (0 picks a free port, see serverAddress)
+          maxWorkers - Number of threads executing commands
         """
 
-        msg = pickle.loads(msg_orig)
-        
-        if msg['cmd'] == 'GetStudents':
-            reply = pickle.dumps(self.GetStudents())
-            self.clientSock.sendall(reply)
-            return True
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        try:
+            asyncio.run(self._Serve(TCP_IP, TCP_PORT))
+        finally:
+            self.executor.shutdown(wait=True)
+            self.serverReady.clear()
 
-        elif msg['cmd'] == 'AddStudent':
-            self.AddStudent(msg['data']['values'])
-            return True
-        
-        elif msg['cmd'] == 'DeleteStudent':
-            self.RemoveStudent(msg['data']['ID'])
-            return True
 
-        elif msg['cmd'] == 'UpdateStudent':
-            self.UpdateStudent(msg['data']['ID'], msg['data']['values'])
-            return True
+    async def _Serve(self, TCP_IP, TCP_PORT):
+        self.loop = asyncio.get_running_loop()
+        self.asyncServer = await asyncio.start_server(self._HandleClient,
+                                                      TCP_IP, TCP_PORT)
+        self.serverAddress = self.asyncServer.sockets[0].getsockname()
+        self.serverReady.set()
 
-        elif msg['cmd'] == 'CloseSocket':
-            self.clientSock.close()
-            return False
-            
+        async with self.asyncServer:
+            try:
+                await self.asyncServer.serve_forever()
+            except asyncio.CancelledError:
+                pass
 
-    def AddStudent(self, values=None):
+
+    async def _HandleClient(self, reader, writer):
         """
-        Add a student with the given name to the database.
-        
-        INPUT:
-          values - Dictionary with key/pair of column name/student info 
+        Handshake with one client and process its messages until it closes.
         """
 
-        if values is not None:
-            formattedValues = (None, values['first_name'], values['last_name'])
-            valStr = ','.join(['?'] * len(formattedValues))
-            sqlStatement = 'INSERT INTO students VALUES (%s)' % valStr
-            self.cursor.execute(sqlStatement, formattedValues)
-            self.conn.commit()
+        clientInitMsg = b'Hello Logic'
+        serverInitReply = b'Hello UI'
+
+        session = AsyncClientSession(self.loop, writer)
+        self.metrics.Connected()
+        try:
+            data = await reader.readexactly(len(clientInitMsg))
+            if data != clientInitMsg:
+                return
+            writer.write(serverInitReply)
+            await writer.drain()
+
+            connectionOpen = True
+            while connectionOpen:
+                buff = await reader.readexactly(Protocol.HEADER.size)
+                msgSize, compressed = Protocol.SplitHeader(buff)
+                buff = await reader.readexactly(msgSize)
+                if compressed:
+                    buff = Protocol.DecompressBody(buff)
+                connectionOpen = await self.loop.run_in_executor(
+                    self.executor, self.ProcessMessage, buff, session)
+        except (asyncio.IncompleteReadError, ConnectionError,
+                asyncio.CancelledError):
+            # Cancelled when the server shuts down with the client connected
+            pass
+        finally:
+            self.Unsubscribe(session)
+            self.metrics.Disconnected()
+            writer.close()
+
+
+    def StopServer(self):
+        """
+        Stop a server started with ServeAsync.
+        """
+
+        if self.loop is not None and self.asyncServer is not None:
+            self.loop.call_soon_threadsafe(self.asyncServer.close)
+
+
+    def ProcessMessage(self, msg_orig, session=None):
+        """
+        Process instructions from UI.
+
+        GetStudents and SearchStudents messages may include a 'format' to
+        choose how the table is sent: 'pickle' (the default) for a pickled 
+        list of (ID, first name, last name) tuples, 'dataframe' for a pickled
+        pandas DataFrame, or 'columnar' for Protocol's columnar format.
+
+        Every command is counted and timed in self.metrics, and GetStats
+        replies with those figures (see GetStats).
+
+        CountStudents, CountByName and CountDuplicates reply with counts
+        computed in SQLite, so summaries do not need the whole table; 
+        CountByName's 'data' holds the arguments of the method of that name.
+
+        ExportStudents replies with a stream of messages instead of one: 
+        chunks of at most 'chunkSize' students in the requested 'format' 
+        ('csv', the default, starting with a header chunk, or any format 
+        accepted by GetStudents), followed by an empty message marking the 
+        end of the stream. StreamStudents replies the same way with the
+        pickled batches from the method of that name, each of at most
+        'batchSize' students.
+
+        A request that fails, even part way through a stream, is answered 
+        with a pickled {'ok':False, 'error':...} dictionary tagged with the
+        negated 'reqID' (see Protocol.REQUEST_ID). Failed requests without 
+        a 'reqID' are only reported on the console. Either way the 
+        connection stays open for further requests.
+
+        INPUT:
+          msg_orig - Pickled dictionary containing command information
+          session  - Client to reply to (default: the client from ConnectUI)
+        """
+
+        if session is None:
+            session = self.session
+
+        start = time.perf_counter()
+        self.metrics.BeginRequest()
+        msg = {}
+
+        failed = True
+        try:
+            with self.metrics.Phase('serialize'):
+                decoded = pickle.loads(msg_orig)
+            # Anything but a dictionary has no reqID to tag the error with
+            if isinstance(decoded, dict):
+                msg = decoded
+            if 'cmd' not in msg:
+                raise ValueError('Request is not a command dictionary')
+            result = self._HandleCommand(msg, session)
+            failed = False
+            return result
+        except OSError:
+            # The client is gone, so there is no one to tell
+            raise
+        except Exception as e:
+            self._SendError(session, msg.get('reqID'), e)
+            return True
+        finally:
+            self.metrics.EndRequest(msg.get('cmd'), start,
+                                    len(msg_orig) + Protocol.HEADER.size,
+                                    failed)
+
+
+    def _SendError(self, session, reqID, error):
+        """
+        Tell a client that its request failed (see ProcessMessage).
+        """
+
+        message = '%s: %s' % (type(error).__name__, error)
+        if reqID is None:
+            print('ERROR: Request failed: %s' % message)
+            return
+
+        reply = {'ok':False, 'error':message}
+        self._Send(session, self._Serialize(reply), -reqID)
+
+
+    def _HandleCommand(self, msg, session):
+        """
+        Carry out one decoded command from ProcessMessage.
+        """
+
+        # Replies to requests carrying a 'reqID' are tagged with it, and 
+        # adds, updates and deletes are acknowledged with their result
+        reqID = msg.get('reqID')
+        
+        if msg['cmd'] == 'GetStudents':
+            fmt = msg.get('format', 'pickle')
+            reply = self._CachedReply(
+                session, ('GetStudents', fmt),
+                lambda: self._EncodeStudents(
+                    self.GetStudents(asDataFrame=False), fmt))
+            self._SendBody(session, reply, reqID)
+            return True
+
+        elif msg['cmd'] == 'GetStudentsPage':
+            pageSize = msg['data']['pageSize']
+            cursor = msg['data'].get('cursor')
+
+            def BuildReply():
+                rows, nextCursor = self.GetStudentsPage(pageSize, cursor,
+                                                        asDataFrame=False)
+                return self._Serialize({'students':rows, 'cursor':nextCursor})
+
+            reply = self._CachedReply(session, 
+                                      ('GetStudentsPage', pageSize, cursor),
+                                      BuildReply)
+            self._SendBody(session, reply, reqID)
+            return True
+
+        elif msg['cmd'] == 'SearchStudents':
+            fmt = msg.get('format', 'pickle')
+            reply = self._CachedReply(
+                session, 
+                ('SearchStudents', fmt) + tuple(sorted(msg['data'].items())),
+                lambda: self._EncodeStudents(
+                    self.SearchStudents(asDataFrame=False, **msg['data']),
+                    fmt))
+            self._SendBody(session, reply, reqID)
+            return True
+
+        elif msg['cmd'] == 'CountStudents':
+            reply = self._CachedReply(
+                session, ('CountStudents',),
+                lambda: self._Serialize(self.CountStudents()))
+            self._SendBody(session, reply, reqID)
+            return True
+
+        elif msg['cmd'] == 'CountByName':
+            data = msg.get('data', {})
+            reply = self._CachedReply(
+                session, ('CountByName',) + tuple(sorted(data.items())),
+                lambda: self._Serialize(self.CountByName(**data)))
+            self._SendBody(session, reply, reqID)
+            return True
+
+        elif msg['cmd'] == 'CountDuplicates':
+            reply = self._CachedReply(
+                session, ('CountDuplicates',),
+                lambda: self._Serialize(self.CountDuplicates()))
+            self._SendBody(session, reply, reqID)
+            return True
+
+        elif msg['cmd'] == 'ExportStudents':
+            fmt = msg['data'].get('format', 'csv')
+            chunkSize = msg['data'].get('chunkSize', 1000)
+            if fmt == 'csv':
+                self._Send(session, self._EncodeCSV([STUDENT_COLUMNS]), reqID)
+            for rows in self.ExportStudents(chunkSize):
+                if fmt == 'csv':
+                    chunk = self._EncodeCSV(rows)
+                else:
+                    chunk = self._EncodeStudents(rows, fmt)
+                self._Send(session, chunk, reqID)
+            self._Send(session, b'', reqID)
+            return True
+
+        elif msg['cmd'] == 'StreamStudents':
+            batchSize = msg.get('data', {}).get('batchSize', 1000)
+            for batch in self.StreamStudents(batchSize):
+                self._Send(session, self._Serialize(batch), reqID)
+            self._Send(session, b'', reqID)
+            return True
+
+        elif msg['cmd'] == 'Negotiate':
+            reply = self._Serialize(self.Negotiate(session, msg['data']))
+            self._Send(session, reply, reqID)
+            return True
+
+        elif msg['cmd'] == 'Subscribe':
+            self.Subscribe(session, reqID)
+            return True
+
+        elif msg['cmd'] == 'Unsubscribe':
+            result = self.Unsubscribe(session)
+            if reqID is not None:
+                self._Send(session, self._Serialize(result), reqID)
+            return True
+
+        elif msg['cmd'] == 'GetCacheStats':
+            reply = self._Serialize(self.replyCache.Stats())
+            self._Send(session, reply, reqID)
+            return True
+
+        elif msg['cmd'] == 'GetStats':
+            self._Send(session, self._Serialize(self.GetStats()), reqID)
+            return True
+
+        elif msg['cmd'] == 'GetPoolStats':
+            stats = None
+            if self.readerPool is not None:
+                stats = self.readerPool.Stats()
+            self._Send(session, self._Serialize(stats), reqID)
+            return True
+
+        elif msg['cmd'] == 'GetStudentsSince':
+            reply = self._Serialize(self.GetStudentsSince(
+                msg['data']['version'], msg['data']['epoch']))
+            self._Send(session, reply, reqID)
+            return True
+
+        elif msg['cmd'] == 'AddStudent':
+            result = self.AddStudent(msg['data']['values'])
+            if reqID is not None:
+                self._Send(session, self._Serialize(result), reqID)
+            return True
+        
+        elif msg['cmd'] == 'DeleteStudent':
+            result = self.RemoveStudent(msg['data']['ID'])
+            if reqID is not None:
+                self._Send(session, self._Serialize(result), reqID)
+            return True
+
+        elif msg['cmd'] == 'UpdateStudent':
+            result = self.UpdateStudent(msg['data']['ID'], 
+                                        msg['data']['values'])
+            if reqID is not None:
+                self._Send(session, self._Serialize(result), reqID)
+            return True
+
+        elif msg['cmd'] == 'Batch':
+            results = self.Batch(msg['data']['ops'])
+            self._Send(session, self._Serialize(results), reqID)
+            return True
+
+        elif msg['cmd'] == 'CloseSocket':
+            session.close()
+            return False
+
+        else:
+            raise ValueError('Unknown command %r' % msg['cmd'])
+            
+
+    def _EncodeStudents(self, rows, fmt='pickle'):
+        """
+        Serialize a table of students for sending to a client.
+
+        INPUT:
+          rows - List of (ID, first name, last name) tuples
+          fmt  - 'pickle', 'dataframe' or 'columnar' (see ProcessMessage)
+        """
+
+        with self.metrics.Phase('serialize'):
+            if fmt == 'pickle':
+                return pickle.dumps(rows)
+            elif fmt == 'dataframe':
+                return pickle.dumps(self._StudentResult(rows, True))
+            elif fmt == 'columnar':
+                columns = [list(column) for column in zip(*rows)]
+                return Protocol.EncodeColumnar(STUDENT_COLUMNS, 
+                                               columns or [[], [], []])
+        raise ValueError('Unknown reply format %r' % fmt)
+
+
+    def _EncodeCSV(self, rows):
+        """
+        Encode rows as UTF-8 CSV lines.
+        """
+
+        with self.metrics.Phase('serialize'):
+            text = io.StringIO()
+            csv.writer(text).writerows(rows)
+            return text.getvalue().encode('utf-8')
+
+
+    def _Serialize(self, reply):
+        """
+        Pickle a reply, timed as the serialize phase.
+        """
+
+        with self.metrics.Phase('serialize'):
+            return pickle.dumps(reply)
+
+
+    def _Send(self, session, payload, reqID=None):
+        """
+        Send a reply, compressed if the client negotiated it and the reply
+        is large enough.
+        """
+
+        self._SendBody(session, self._EncodeBody(session, payload), reqID)
+
+
+    def _EncodeBody(self, session, payload):
+        """
+        Return the body of a reply to a client and whether it is compressed
+        (see Protocol.EncodeBody).
+        """
+
+        compressAbove = getattr(session, 'compressAbove', None)
+        if compressAbove is None or len(payload) < compressAbove:
+            return payload, False
+
+        with self.metrics.Phase('compress'):
+            encoded = Protocol.EncodeBody(payload, compressAbove)
+        self.metrics.Compressed(len(payload), len(encoded[0]))
+        return encoded
+
+
+    def _SendBody(self, session, encoded, reqID=None):
+        """
+        Send a reply body from _EncodeBody.
+        """
+
+        message = Protocol.FrameMessage(*encoded, reqID)
+        with self.metrics.Phase('send'):
+            session.sendall(message)
+        self.metrics.Sent(len(message))
+
+
+    def _CachedReply(self, session, key, BuildReply):
+        """
+        Return the cached reply body for a query (see _EncodeBody), building
+        and caching it if the data has changed since it was last built.
+
+        Replies are cached as sent, so a hit costs neither serializing nor 
+        compressing the reply again. Clients with different compression 
+        settings get separate entries.
+
+        INPUT:
+          session    - Client the reply is for
+          key        - Tuple identifying the query and its parameters
+          BuildReply - Function returning the serialized reply
+        """
+
+        # Read the version first so a reply built while a write commits is 
+        # filed under the older version and never served as current
+        key = (self.version, getattr(session, 'compressAbove', None)) + key
+        reply = self.replyCache.Get(key)
+        if reply is None:
+            reply = self._EncodeBody(session, BuildReply())
+            self.replyCache.Put(key, reply)
+        return reply
+
+
+    def _Write(self, Apply):
+        """
+        Run a write in a transaction and commit it.
+
+        In 'group' durability mode the write is handed to the group committer
+        instead, and this returns once the group it joined is committed.
+
+        INPUT:
+          Apply - Function executing the write's statements on self.cursor,
+                  returning its result and a list of row changes for
+                  _RecordChanges
+
+        OUTPUT:
+          result - Value returned by Apply
+        """
+
+        with self.metrics.Phase('db'):
+            if self.groupCommitter is not None:
+                return self.groupCommitter.Submit(Apply)
+
+            with self.dbLock:
+                try:
+                    result, changes = Apply()
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+                self.conn.commit()
+                self._RecordChanges(changes)
+            return result
+
+
+    def AddStudent(self, values=None):
+        """
+        Add a student with the given name to the database.
+        
+        INPUT:
+          values - Dictionary with key/pair of column name/student info 
+
+        OUTPUT:
+          id - New student's ID number
+        """
+
+        if values is not None:
+            formattedValues = (None, values['first_name'], values['last_name'])
+            valStr = ','.join(['?'] * len(formattedValues))
+            sqlStatement = 'INSERT INTO students VALUES (%s)' % valStr
+
+            def Apply():
+                self.cursor.execute(sqlStatement, formattedValues)
+                id = self.cursor.lastrowid
+                return id, [('insert', id, values['first_name'],
+                             values['last_name'])]
+
+            return self._Write(Apply)
 
             
     def UpdateStudent(self, id=None, values=None):
@@ -123,14 +1436,24 @@ class LogicLayer:
         INPUT:
           id     - Student's ID number in database
           values - Dictionary with key/pair of column name/student info 
+
+        OUTPUT:
+          count - Number of students updated (0 or 1)
         """
 
         if id is not None and values is not None:
             formattedValues =  (values['first_name'], values['last_name'], id)
-            self.cursor.execute('''UPDATE students SET first_name = ?, 
-                                   last_name = ? WHERE id = ?''',
-                                formattedValues)
-            self.conn.commit()
+
+            def Apply():
+                self.cursor.execute('''UPDATE students SET first_name = ?, 
+                                       last_name = ? WHERE id = ?''',
+                                    formattedValues)
+                if self.cursor.rowcount > 0:
+                    return 1, [('update', id, values['first_name'],
+                                values['last_name'])]
+                return 0, []
+
+            return self._Write(Apply)
 
             
     def RemoveStudent(self, id=None):
@@ -139,29 +1462,1029 @@ class LogicLayer:
 
         INPUT:
           id     - Student's ID number in database
+
+        OUTPUT:
+          count - Number of students removed (0 or 1)
         """
 
         if id is not None:
             secureID = (id,)
-            self.cursor.execute('DELETE FROM students WHERE id = ?',  secureID)
-            self.conn.commit()
+
+            def Apply():
+                self.cursor.execute('DELETE FROM students WHERE id = ?',
+                                    secureID)
+                if self.cursor.rowcount > 0:
+                    return 1, [('delete', id, None, None)]
+                return 0, []
+
+            return self._Write(Apply)
 
             
-    def GetStudents(self):
+    def Batch(self, ops):
+        """
+        Apply many add, update and delete operations in one transaction.
+
+        Consecutive operations of the same kind are handed to SQLite together
+        with executemany, and everything is committed once at the end. If any
+        operation fails, none of them are applied.
+
+        INPUT:
+          ops - List of dictionaries formatted like the AddStudent, 
+                UpdateStudent and DeleteStudent messages
+
+        OUTPUT:
+          results - List with one entry per operation: the new student's ID 
+                    for an add, or the number of students changed (0 or 1)
+                    for an update or delete
+        """
+
+        def Apply():
+            results = []
+            changes = []
+            for cmd, group in itertools.groupby(ops, lambda op: op['cmd']):
+                data = [op['data'] for op in group]
+                results += self._BatchGroup(cmd, data, changes)
+            return results, changes
+
+        return self._Write(Apply)
+
+
+    def ImportStudents(self, names):
+        """
+        Add many students in one transaction without logging each row.
+
+        Clients following changes with GetStudentsSince are sent a full reset
+        afterwards instead of one change per student.
+
+        INPUT:
+          names - Iterable of (first name, last name) tuples
+
+        OUTPUT:
+          count - Number of students added
+        """
+
+        def Apply():
+            # The new students get IDs from one past the highest on
+            self.cursor.execute('SELECT coalesce(max(id), 0) + 1 '
+                                'FROM students')
+            firstID = self.cursor.fetchone()[0]
+            self.cursor.executemany(
+                'INSERT INTO students (first_name, last_name) VALUES (?,?)',
+                names)
+            return self.cursor.rowcount, [('reset', firstID, None, None)]
+
+        return self._Write(Apply)
+
+
+    def _BatchGroup(self, cmd, data, changes):
+        """
+        Execute a run of operations of one kind within the open transaction,
+        appending the resulting row changes to changes.
+        """
+
+        if cmd == 'AddStudent':
+            formattedValues = [(None, d['values']['first_name'], 
+                                d['values']['last_name']) for d in data]
+            self.cursor.executemany('INSERT INTO students VALUES (?,?,?)',
+                                    formattedValues)
+
+            # New rows get consecutive IDs ending with the last one inserted
+            self.cursor.execute('SELECT last_insert_rowid()')
+            lastID = self.cursor.fetchone()[0]
+            ids = list(range(lastID - len(data) + 1, lastID + 1))
+            changes += [('insert', id, f, l) for id, (_, f, l) 
+                        in zip(ids, formattedValues)]
+            return ids
+
+        elif cmd == 'UpdateStudent':
+            formattedValues = [(d['values']['first_name'], 
+                                d['values']['last_name'], d['ID'])
+                               for d in data]
+            existing = self._ExistingIDs([d['ID'] for d in data])
+            self.cursor.executemany('''UPDATE students SET first_name = ?, 
+                                       last_name = ? WHERE id = ?''',
+                                    formattedValues)
+            changes += [('update', id, f, l) for f, l, id in formattedValues
+                        if id in existing]
+            return [int(d['ID'] in existing) for d in data]
+
+        elif cmd == 'DeleteStudent':
+            existing = self._ExistingIDs([d['ID'] for d in data])
+            self.cursor.executemany('DELETE FROM students WHERE id = ?',
+                                    [(d['ID'],) for d in data])
+            results = []
+            for d in data:
+                if d['ID'] in existing:
+                    changes.append(('delete', d['ID'], None, None))
+                results.append(int(d['ID'] in existing))
+                existing.discard(d['ID'])
+            return results
+
+        raise ValueError('Unknown batch command %r' % cmd)
+
+
+    def _ExistingIDs(self, ids, chunkSize=500):
+        """
+        Return the subset of the given IDs that are currently in the table.
+        """
+
+        existing = set()
+        ids = list(set(ids))
+        for start in range(0, len(ids), chunkSize):
+            chunk = ids[start:start + chunkSize]
+            valStr = ','.join(['?'] * len(chunk))
+            self.cursor.execute('SELECT id FROM students WHERE id IN (%s)'
+                                % valStr, chunk)
+            existing.update(row[0] for row in self.cursor.fetchall())
+        return existing
+
+
+    def _RecordChanges(self, changes):
+        """
+        Append committed row changes to the change log. Must be called with
+        dbLock held, right after the commit.
+
+        INPUT:
+          changes - List of (operation, ID, first name, last name) tuples, 
+                    where operation is 'insert', 'update' or 'delete', or 
+                    'reset' for a write changing too many rows to log. A 
+                    reset from a bulk import carries the first ID it added
+                    (None for any other reset).
+        """
+
+        # Replica queries do not wait for dbLock, so the replica has to hold
+        # the changes before the version moves on. A query may then pair new
+        # rows with the old version, which replaying the changes fixes, but
+        # never old rows with the new version.
+        if self.replica is not None and changes:
+            self._ApplyToReplica(changes)
+
+        logged = []
+        for change in changes:
+            self.version += 1
+            logged.append((self.version,) + tuple(change))
+            if change[0] == 'reset':
+                # Anyone behind this version has to reload every student
+                self.changeLog.clear()
+            else:
+                self.changeLog.append(logged[-1])
+
+        if changes:
+            self.replyCache.Clear()
+            for subscription in self.subscriptions:
+                subscription.Publish(logged)
+
+
+    def RefreshReplica(self):
+        """
+        Copy the whole database into the replica with the backup API.
+        """
+
+        with self.dbLock, self.replicaLock:
+            self.conn.backup(self.replica)
+            self.replicaRefreshes += 1
+
+
+    def _ApplyToReplica(self, changes):
+        """
+        Apply committed changes (see _RecordChanges) to the replica. Must be 
+        called with dbLock held.
+        """
+
+        if any(op == 'reset' and id is None for op, id, _, _ in changes):
+            self.RefreshReplica()
+            return
+
+        with self.replicaLock:
+            for op, id, firstName, lastName in changes:
+                if op == 'reset':
+                    # A bulk import only added students, from this ID on, 
+                    # so only they are copied
+                    self.replica.executemany(
+                        'INSERT OR REPLACE INTO students VALUES (?,?,?)',
+                        self.conn.execute('SELECT id, first_name, last_name '
+                                          'FROM students WHERE id >= ?', 
+                                          (id,)))
+                elif op == 'delete':
+                    self.replica.execute('DELETE FROM students WHERE id = ?',
+                                         (id,))
+                else:
+                    self.replica.execute('INSERT OR REPLACE INTO students '
+                                         'VALUES (?,?,?)',
+                                         (id, firstName, lastName))
+            self.replica.commit()
+            self.replicaChanges += len(changes)
+
+
+    def Subscribe(self, session, reqID):
+        """
+        Push change events to a client as changes are committed (see 
+        Subscription). The events are tagged with reqID, which is required.
+        """
+
+        if reqID is None:
+            raise ValueError('Subscribe needs a reqID to tag events with')
+
+        with self.dbLock:
+            self.subscriptions.append(
+                Subscription(self, session, reqID, self.maxPendingEvents))
+
+
+    def Unsubscribe(self, session, subscription=None):
+        """
+        End a client's subscriptions, or just the given one.
+
+        OUTPUT:
+          count - Number of subscriptions ended
+        """
+
+        with self.dbLock:
+            ending = [s for s in self.subscriptions if s.session is session
+                      and subscription in (None, s)]
+            self.subscriptions = [s for s in self.subscriptions 
+                                  if s not in ending]
+        for s in ending:
+            s.Close()
+        return len(ending)
+
+
+    def GetStudentsSince(self, version=None, epoch=None):
+        """
+        Return the changes made to the students table after a given version.
+
+        If the changes cannot be supplied (no version given, the version is
+        from another server run, or it is older than the change log), every
+        student is returned instead and the reply is marked as a reset.
+
+        INPUT:
+          version - Version the caller last saw
+          epoch   - Epoch returned along with that version
+
+        OUTPUT:
+          reply - Dictionary with the current 'epoch' and 'version', and 
+                  either 'reset': False with a list of 'changes', each a tuple
+                  (version, operation, ID, first name, last name), or 
+                  'reset': True with 'students', a list of (ID, first name,
+                  last name) tuples ordered by ID
+        """
+
+        with self.dbLock:
+            reply = {'epoch':self.epoch, 'version':self.version}
+            oldest = self.changeLog[0][0] if self.changeLog else self.version + 1
+
+            reply['reset'] = (epoch != self.epoch or version is None or 
+                              not oldest - 1 <= version <= self.version)
+            if not reply['reset']:
+                start = version - oldest + 1
+                reply['changes'] = list(itertools.islice(self.changeLog,
+                                                         start, None))
+
+        if reply['reset']:
+            # Read after taking the version: the rows may already include
+            # later changes, but those are whole-row states, so replaying
+            # them over this snapshot still ends up current
+            reply['students'] = self._QueryStudents()
+        return reply
+
+
+    def _QueryStudents(self, where='', params=(), orderBy=('id',),
+                       descending=False, limit=None):
+        """
+        Select students.
+
+        INPUT:
+          where      - Conditions for the WHERE clause ('' for every student)
+          params     - Parameters for placeholders in where
+          orderBy    - Columns to sort by, ending with id so the order is 
+                       total
+          descending - Reverse the sort order
+          limit      - Maximum number of students to return (None for all)
+
+        OUTPUT:
+          rows - List of (ID, first name, last name) tuples
+        """
+
+        return self._FetchAll(*self._StudentQuery(where, params, orderBy,
+                                                  descending, limit))
+
+
+    def _StudentQuery(self, where, params, orderBy, descending, limit):
+        """
+        Return the SQL statement and parameters for _QueryStudents.
+        """
+
+        sqlStatement = 'SELECT id, first_name, last_name FROM students'
+        params = list(params)
+        if where:
+            sqlStatement += ' WHERE ' + where
+        direction = ' DESC' if descending else ''
+        sqlStatement += ' ORDER BY ' + ', '.join(column + direction
+                                                 for column in orderBy)
+        if limit is not None:
+            sqlStatement += ' LIMIT ?'
+            params.append(limit)
+        return sqlStatement, params
+
+
+    def _FetchAll(self, sqlStatement, params=()):
+        """
+        Run a read-only query, on the replica or reader pool if there is 
+        one.
+
+        OUTPUT:
+          rows - List of result tuples
+        """
+
+        with self.metrics.Phase('db'):
+            if self.replica is not None:
+                with self.replicaLock:
+                    return self.replica.execute(sqlStatement, 
+                                                params).fetchall()
+
+            if self.readerPool is not None:
+                with self.readerPool.Connection() as conn:
+                    return conn.execute(sqlStatement, params).fetchall()
+
+            with self.dbLock:
+                self.cursor.execute(sqlStatement, params)
+                return self.cursor.fetchall()
+
+
+    def _StudentResult(self, rows, asDataFrame):
+        """
+        Return rows from _QueryStudents as they were asked for. pandas is 
+        only imported when a DataFrame is wanted.
+        """
+
+        if not asDataFrame:
+            return rows
+
+        import pandas as pd
+        return pd.DataFrame(rows, columns=STUDENT_COLUMNS)
+
+
+    def GetStudents(self, asDataFrame=True):
         """
         Return all students in the database.
 
+        INPUT:
+          asDataFrame - Return a DataFrame rather than a list of tuples
+
         OUTPUT:
-          df - DataFrame with columns for ID, First Name, and Last Name
+          df - DataFrame with columns for ID, First Name, and Last Name, or a
+               list of (ID, first name, last name) tuples
+        """
+
+        return self._StudentResult(self._QueryStudents(), asDataFrame)
+
+
+    def GetStudentsPage(self, pageSize=100, cursor=None, asDataFrame=True):
         """
-        df = pd.read_sql_query('''SELECT id AS ID, first_name AS "First Name", 
-                                  last_name AS "Last Name" FROM students''',
-                               self.conn)
-        return df
+        Return one page of students ordered by ID.
+
+        Pages are found by seeking past the last ID of the previous page 
+        rather than with OFFSET, so every page costs the same to fetch no 
+        matter how deep into the table it is.
+
+        INPUT:
+          pageSize    - Maximum number of students to return
+          cursor      - Cursor returned with the previous page (None for the 
+                        first page)
+          asDataFrame - Return a DataFrame rather than a list of tuples
+
+        OUTPUT:
+          df         - DataFrame with columns for ID, First Name, and Last Name
+                       (or list of tuples)
+          nextCursor - Cursor for the following page, or None if this is the
+                       last page
+        """
+
+        if not isinstance(pageSize, int) or pageSize <= 0:
+            raise ValueError('pageSize must be a positive integer')
+
+        if cursor is None:
+            rows = self._QueryStudents(limit=pageSize)
+        else:
+            rows = self._QueryStudents('id > ?', (cursor,), limit=pageSize)
+
+        nextCursor = None
+        if len(rows) == pageSize:
+            nextCursor = rows[-1][0]
+        return self._StudentResult(rows, asDataFrame), nextCursor
+
+
+    def ExportStudents(self, chunkSize=1000):
+        """
+        Generate every student ordered by ID, a chunk at a time.
+
+        Each chunk is fetched as a separate page (see GetStudentsPage), so 
+        memory stays bounded by the chunk size and no connection or lock is
+        held while the caller handles a chunk. Changes committed during an 
+        export show up in the chunks not yet fetched.
+
+        INPUT:
+          chunkSize - Maximum number of students per chunk
+
+        OUTPUT:
+          Lists of (ID, first name, last name) tuples
+        """
+
+        if chunkSize <= 0:
+            raise ValueError('chunkSize must be positive')
+
+        cursor = None
+        while True:
+            rows, cursor = self.GetStudentsPage(chunkSize, cursor,
+                                                asDataFrame=False)
+            if rows:
+                yield rows
+            if cursor is None:
+                return
+
+
+    def StreamStudents(self, batchSize=1000):
+        """
+        Generate every student ordered by ID in batches, for a client to 
+        show each batch as it arrives.
+
+        Batches are fetched one at a time as by ExportStudents, so the first
+        arrives as quickly however large the table is. They carry the 
+        version from before the first was fetched, and may already include
+        later changes; replaying the changes since that version (see 
+        GetStudentsSince) brings the whole table up to date.
+
+        INPUT:
+          batchSize - Maximum number of students per batch
+
+        OUTPUT:
+          Dictionaries with the 'epoch' and 'version', and the 'students' in
+          the batch as a list of (ID, first name, last name) tuples. There 
+          is always at least one batch, empty if there are no students.
+        """
+
+        epoch = self.epoch
+        version = self.version
+        empty = True
+        for rows in self.ExportStudents(batchSize):
+            empty = False
+            yield {'epoch':epoch, 'version':version, 'students':rows}
+        if empty:
+            yield {'epoch':epoch, 'version':version, 'students':[]}
+
+
+    def SearchStudents(self, firstName=None, lastName=None, match='prefix',
+                       sortBy='id', descending=False, limit=None,
+                       asDataFrame=True):
+        """
+        Find students by first and/or last name.
+
+        Prefix matches are run as range conditions on the name indexes, so
+        SQLite seeks straight to the matching students. Matching is case
+        sensitive.
+
+        INPUT:
+          firstName   - First name or prefix to match (None matches any)
+          lastName    - Last name or prefix to match (None matches any)
+          match       - 'prefix' or 'exact'
+          sortBy      - 'id', 'last_name' or 'first_name'
+          descending  - Reverse the sort order
+          limit       - Maximum number of students to return (None for all)
+          asDataFrame - Return a DataFrame rather than a list of tuples
+
+        OUTPUT:
+          df - DataFrame with columns for ID, First Name, and Last Name, or a
+               list of (ID, first name, last name) tuples
+        """
+
+        if match not in ('prefix', 'exact'):
+            raise ValueError('Unknown match type %r' % match)
+        if sortBy not in SORT_ORDERS:
+            raise ValueError('Unknown sort order %r' % sortBy)
+
+        conditions = []
+        params = []
+        for column, value in (('first_name', firstName),
+                              ('last_name', lastName)):
+            if value is None:
+                continue
+            if match == 'exact':
+                conditions.append('%s = ?' % column)
+                params.append(value)
+            elif value:
+                condition, conditionParams = self._PrefixCondition(column,
+                                                                   value)
+                conditions.append(condition)
+                params += conditionParams
+
+        rows = self._QueryStudents(' AND '.join(conditions), params,
+                                   SORT_ORDERS[sortBy], descending, limit)
+        return self._StudentResult(rows, asDataFrame)
+
+
+    def _PrefixCondition(self, column, prefix):
+        """
+        Return a condition matching names in column starting with a 
+        non-empty prefix, and its parameters.
+        """
+
+        # Everything starting with the prefix sorts between the prefix and 
+        # the prefix with its last character incremented. The last possible
+        # character has no successor, so it is dropped and the one before 
+        # incremented instead, and surrogates are skipped as SQLite cannot 
+        # store them.
+        upper = prefix.rstrip(chr(sys.maxunicode))
+        if not upper:
+            return '%s >= ?' % column, [prefix]
+
+        successor = ord(upper[-1]) + 1
+        if 0xD800 <= successor <= 0xDFFF:
+            successor = 0xE000
+        upper = upper[:-1] + chr(successor)
+        return '%s >= ? AND %s < ?' % (column, column), [prefix, upper]
+
+
+    def CountStudents(self):
+        """
+        Return the number of students.
+        """
+
+        return self._CountGroups([])[0][0]
+
+
+    def CountByName(self, column='last_name', length=1, prefix=''):
+        """
+        Count students by the start of their first or last name, e.g. by
+        last-name initial.
+
+        INPUT:
+          column - 'last_name' or 'first_name'
+          length - Number of leading characters to group by
+          prefix - Only count names starting with this
+
+        OUTPUT:
+          counts - List of (leading characters, count) tuples in order
+        """
+
+        if column not in ('first_name', 'last_name'):
+            raise ValueError('Unknown name column %r' % column)
+        if int(length) <= 0:
+            raise ValueError('length must be positive')
+
+        where, params = '', ()
+        if prefix:
+            where, params = self._PrefixCondition(column, prefix)
+        return self._CountGroups(['substr(%s, 1, %d)' % (column, int(length))],
+                                 where, params)
+
+
+    def CountDuplicates(self):
+        """
+        Count the full names shared by more than one student.
+
+        OUTPUT:
+          counts - Dictionary with the number of shared 'names' and of 
+                   'students' having one of them
+        """
+
+        rows = self._CountGroups(['first_name', 'last_name'], minCount=2)
+        return {'names':len(rows), 
+                'students':sum(row[-1] for row in rows)}
+
+
+    def _CountGroups(self, groups, where='', params=(), minCount=None):
+        """
+        Count students in groups with GROUP BY.
+
+        INPUT:
+          groups   - SQL expressions to group by ([] to count every student)
+          where    - Conditions for the WHERE clause ('' for every student)
+          params   - Parameters for placeholders in where
+          minCount - Leave out groups with fewer students (None for all)
+
+        OUTPUT:
+          rows - List of (group values..., count) tuples ordered by group
+        """
+
+        return self._FetchAll(*self._GroupQuery(groups, where, params,
+                                                minCount))
+
+
+    def _GroupQuery(self, groups, where, params, minCount):
+        """
+        Return the SQL statement and parameters for _CountGroups.
+        """
+
+        sqlStatement = ('SELECT ' + ''.join(group + ', ' for group in groups) 
+                        + 'count(*) FROM students')
+        params = list(params)
+        if where:
+            sqlStatement += ' WHERE ' + where
+        if groups:
+            sqlStatement += ' GROUP BY ' + ', '.join(groups)
+            if minCount is not None:
+                sqlStatement += ' HAVING count(*) >= ?'
+                params.append(minCount)
+            sqlStatement += ' ORDER BY ' + ', '.join(groups)
+        return sqlStatement, params
+
+
+
+# Read-only connections opened by shard query processes, by database path
+_shardConnections = {}
+
+
+def _QueryShard(dbName, sqlStatement, params, profile='default'):
+    """
+    Run a read-only query on one shard. Runs in a ShardedLogicLayer's 
+    process pool, reusing a connection per shard in each process.
+    """
+
+    conn = _shardConnections.get(dbName)
+    if conn is None:
+        uri = pathlib.Path(dbName).resolve().as_uri() + '?mode=ro'
+        conn = _shardConnections[dbName] = sqlite3.connect(uri, uri=True)
+        ApplyProfile(conn, profile, CONNECTION_SETTINGS)
+    return conn.execute(sqlStatement, params).fetchall()
+
+
+class ShardedLogicLayer(LogicLayer):
+    """
+    LogicLayer storing students across several database files.
+
+    Each student lives in the shard chosen from its ID, either by hash (the 
+    ID modulo the number of shards) or by range (rangeSize consecutive IDs 
+    per shard, with the last shard taking every ID beyond). IDs are allocated
+    here, one past the highest in any shard, as SQLite does for one table.
+
+    Each shard records its place in the layout (see SHARD_LAYOUT_TABLE), and
+    opening it with a different partitioning, number of shards or position 
+    is refused. A database that is not yet a shard can be given as one only 
+    if every student in it belongs to that shard.
+
+    Writes go to the shards owning the students. A Batch touching several
+    shards commits them one after another, so it is atomic within each shard
+    but not across them. Queries run on every shard at once in a pool of 
+    processes, each shard returning its rows in order, and the rows are 
+    merged. Group commit and reader pools are not supported.
+
+    INPUT:
+      shardNames - Paths to the shard databases, created if needed
+      partition  - 'hash' or 'range'
+      rangeSize  - IDs per shard with 'range' partitioning
+      processes  - Processes querying shards (default: one per shard)
+      **kwargs   - Other LogicLayer arguments
+    """
+
+    def __init__(self, shardNames, partition='hash', rangeSize=1000000,
+                 processes=None, **kwargs):
+
+        if partition not in ('hash', 'range'):
+            raise ValueError('Unknown partitioning %r' % partition)
+        if (kwargs.get('durability') == 'group' or 
+                kwargs.get('readPoolSize') or kwargs.get('replica')):
+            raise ValueError('Sharding does not support group commit, a '
+                             'reader pool or a replica')
+
+        self.shardNames = list(shardNames)
+        self.partition = partition
+        self.rangeSize = rangeSize
+
+        # Every shard is checked before any is marked with the layout
+        conns = [sqlite3.connect(dbName) for dbName in self.shardNames]
+        try:
+            unmarked = [shard for shard, conn in enumerate(conns)
+                        if not self._CheckLayout(conn, shard)]
+            for shard in unmarked:
+                conns[shard].execute('INSERT INTO shard_layout '
+                                     'VALUES (?,?,?,?)', self._Layout(shard))
+                conns[shard].commit()
+        finally:
+            for conn in conns:
+                conn.close()
+
+        # The first shard is also the connection LogicLayer itself uses
+        super().__init__(self.shardNames[0], **kwargs)
+
+        self.shardConns = [self.conn]
+        for dbName in self.shardNames[1:]:
+            conn = sqlite3.connect(dbName, check_same_thread=False)
+            ApplyProfile(conn, self.profile)
+            conn.execute(SHARD_TABLE)
+            self.MigrateSchema(conn)
+            if kwargs.get('durability', 'default') != 'default':
+                conn.execute('PRAGMA journal_mode = WAL')
+                conn.execute('PRAGMA synchronous = FULL')
+            self.shardConns.append(conn)
+
+        self.nextID = 1 + max(
+            conn.execute('SELECT coalesce(max(id), 0) FROM students')
+                .fetchone()[0] for conn in self.shardConns)
+
+        # Workers start on the first query, from whichever thread runs it, 
+        # so they are spawned afresh rather than forked with other threads'
+        # locks held
+        self.queryPool = ProcessPoolExecutor(
+            processes or len(shardNames),
+            mp_context=multiprocessing.get_context('spawn'))
+
+
+    def Close(self):
+
+        self.queryPool.shutdown(wait=True)
+        for conn in self.shardConns[1:]:
+            conn.close()
+        super().Close()
+
+
+    def _Layout(self, shard):
+        """
+        Return the row of SHARD_LAYOUT_TABLE for a shard.
+        """
+
+        return (shard, len(self.shardNames), self.partition,
+                self.rangeSize if self.partition == 'range' else None)
+
+
+    def _CheckLayout(self, conn, shard):
+        """
+        Check that a database can be shard number shard of this layout.
+
+        OUTPUT:
+          marked - Whether the database is already marked as that shard
+        """
+
+        conn.execute(SHARD_TABLE)
+        conn.execute(SHARD_LAYOUT_TABLE)
+        layout = self._Layout(shard)
+
+        stored = conn.execute('SELECT shard, shards, partition, range_size '
+                              'FROM shard_layout').fetchone()
+        if stored is not None:
+            if tuple(stored) != layout:
+                raise ValueError(
+                    '%s is shard %d of %d with %s partitioning (range size '
+                    '%s), not shard %d of %d with %s partitioning (range '
+                    'size %s)' % ((self.shardNames[shard],) + tuple(stored) 
+                                  + layout))
+            return True
+
+        for (id,) in conn.execute('SELECT id FROM students'):
+            if self.Shard(id) != shard:
+                raise ValueError('%s holds student %d, which belongs in '
+                                 'shard %d, not %d' 
+                                 % (self.shardNames[shard], id, 
+                                    self.Shard(id), shard))
+        return False
+
+
+    def Shard(self, id):
+        """
+        Return the index of the shard owning the student with the given ID.
+        """
+
+        if self.partition == 'hash':
+            return id % len(self.shardNames)
+        return min((id - 1) // self.rangeSize, len(self.shardNames) - 1)
+
+
+    def _AllocateID(self):
+        """
+        Return the next student ID. Must be called with dbLock held.
+        IDs given to writes that fail are not reused.
+        """
+
+        id = self.nextID
+        self.nextID += 1
+        return id
+
+
+    def _ExecuteOnShards(self, statements, many=False):
+        """
+        Run statements on their shards and commit every shard written to.
+        If any statement fails, no shard is committed.
+
+        INPUT:
+          statements - List of (shard, SQL statement, parameters) tuples
+          many       - Parameters are sequences for executemany
+
+        OUTPUT:
+          counts - Number of rows changed by each statement
+        """
+
+        with self.metrics.Phase('db'), self.dbLock:
+            written = set()
+            counts = []
+            try:
+                for shard, sqlStatement, params in statements:
+                    conn = self.shardConns[shard]
+                    written.add(shard)
+                    if many:
+                        counts.append(
+                            conn.executemany(sqlStatement, params).rowcount)
+                    else:
+                        counts.append(
+                            conn.execute(sqlStatement, params).rowcount)
+            except BaseException:
+                for shard in written:
+                    self.shardConns[shard].rollback()
+                raise
+
+            for shard in sorted(written):
+                self.shardConns[shard].commit()
+        return counts
+
+
+    def AddStudent(self, values=None):
+        if values is not None:
+            return self.Batch([{'cmd':'AddStudent',
+                                'data':{'values':values}}])[0]
+
+
+    def UpdateStudent(self, id=None, values=None):
+        if id is not None and values is not None:
+            return self.Batch([{'cmd':'UpdateStudent',
+                                'data':{'ID':id, 'values':values}}])[0]
+
+
+    def RemoveStudent(self, id=None):
+        if id is not None:
+            return self.Batch([{'cmd':'DeleteStudent', 'data':{'ID':id}}])[0]
+
+
+    def Batch(self, ops):
+        """
+        Apply many add, update and delete operations, as LogicLayer.Batch,
+        routing each to its student's shard.
+        """
+
+        with self.dbLock:
+            statements = []
+            changes = []
+            for op in ops:
+                cmd, data = op['cmd'], op['data']
+                if cmd == 'AddStudent':
+                    id = self._AllocateID()
+                    firstName = data['values']['first_name']
+                    lastName = data['values']['last_name']
+                    statements.append((self.Shard(id),
+                                       'INSERT INTO students VALUES (?,?,?)',
+                                       (id, firstName, lastName)))
+                    changes.append(('insert', id, firstName, lastName))
+                elif cmd == 'UpdateStudent':
+                    id = data['ID']
+                    firstName = data['values']['first_name']
+                    lastName = data['values']['last_name']
+                    statements.append((self.Shard(id),
+                                       '''UPDATE students SET first_name = ?,
+                                          last_name = ? WHERE id = ?''',
+                                       (firstName, lastName, id)))
+                    changes.append(('update', id, firstName, lastName))
+                elif cmd == 'DeleteStudent':
+                    id = data['ID']
+                    statements.append((self.Shard(id),
+                                       'DELETE FROM students WHERE id = ?',
+                                       (id,)))
+                    changes.append(('delete', id, None, None))
+                else:
+                    raise ValueError('Unknown batch command %r' % cmd)
+
+            counts = self._ExecuteOnShards(statements)
+            self._RecordChanges([change for change, count 
+                                 in zip(changes, counts) if count])
+
+        return [change[1] if change[0] == 'insert' else count
+                for change, count in zip(changes, counts)]
+
+
+    def ImportStudents(self, names):
+        """
+        Add many students, as LogicLayer.ImportStudents, spread over the
+        shards.
+        """
+
+        with self.dbLock:
+            rows = defaultdict(list)
+            for firstName, lastName in names:
+                id = self._AllocateID()
+                rows[self.Shard(id)].append((id, firstName, lastName))
+
+            counts = self._ExecuteOnShards(
+                [(shard, 'INSERT INTO students VALUES (?,?,?)', shardRows)
+                 for shard, shardRows in rows.items()], many=True)
+            self._RecordChanges([('reset', None, None, None)])
+        return sum(counts)
+
+
+    def _QueryStudents(self, where='', params=(), orderBy=('id',),
+                       descending=False, limit=None):
+        """
+        Run a student query on every shard in parallel and merge the rows 
+        in order (see LogicLayer._QueryStudents).
+        """
+
+        sqlStatement, params = self._StudentQuery(where, params, orderBy,
+                                                  descending, limit)
+        with self.metrics.Phase('db'):
+            shardRows = list(self.queryPool.map(
+                _QueryShard, self.shardNames,
+                [sqlStatement] * len(self.shardNames),
+                [params] * len(self.shardNames),
+                [self.profile] * len(self.shardNames)))
+
+        key = itemgetter(*[STUDENT_FIELDS[column] for column in orderBy])
+        rows = heapq.merge(*shardRows, key=key, reverse=descending)
+        return list(itertools.islice(rows, limit))
+
+
+    def _CountGroups(self, groups, where='', params=(), minCount=None):
+        """
+        Count students in groups on every shard in parallel and add up the
+        counts (see LogicLayer._CountGroups).
+        """
+
+        # A group can be small on every shard but large in all, so minCount
+        # can only be applied to the totals
+        sqlStatement, params = self._GroupQuery(groups, where, params, None)
+        with self.metrics.Phase('db'):
+            shardRows = list(self.queryPool.map(
+                _QueryShard, self.shardNames,
+                [sqlStatement] * len(self.shardNames),
+                [params] * len(self.shardNames),
+                [self.profile] * len(self.shardNames)))
+
+        counts = defaultdict(int)
+        for row in itertools.chain(*shardRows):
+            counts[row[:-1]] += row[-1]
+        return [group + (count,) for group, count in sorted(counts.items())
+                if minCount is None or count >= minCount]
 
     
 if __name__ == '__main__':
-    
-    ll = LogicLayer()
-    ll.ConnectUI()
-    ll.WaitForMessages()
+
+    parser = argparse.ArgumentParser(description='Student database server')
+    parser.add_argument('--db', default='students.db',
+                        help='Path to database')
+    parser.add_argument('--host', default='127.0.0.1', help='IP address')
+    parser.add_argument('--port', type=int, default=5005, help='Port')
+    parser.add_argument('--serve-async', action='store_true',
+                        help='Serve many clients at once using asyncio')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Worker threads for --serve-async')
+    parser.add_argument('--durability', default='default',
+                        choices=['default', 'wal', 'group'],
+                        help='How writes are committed')
+    parser.add_argument('--commit-window', type=float, default=0.002,
+                        help='Seconds a group commit waits for more writes')
+    parser.add_argument('--max-group-size', type=int, default=64,
+                        help='Most writes in one group commit')
+    parser.add_argument('--read-pool-size', type=int, default=0,
+                        help='Read-only connections for parallel queries')
+    parser.add_argument('--stats-log',
+                        help='File to append server statistics to')
+    parser.add_argument('--stats-interval', type=float, default=60.0,
+                        help='Seconds between lines in --stats-log')
+    parser.add_argument('--compress-above', type=int, default=16384,
+                        help='Reply size from which to compress for clients '
+                             'that support it (negative to disable)')
+    parser.add_argument('--profile', default='default',
+                        choices=list(TUNING_PROFILES),
+                        help='Storage tuning profile')
+    parser.add_argument('--replica', action='store_true',
+                        help='Serve queries from an in-memory replica')
+    parser.add_argument('--shards', nargs='+',
+                        help='Store students across these database files '
+                             'instead of --db')
+    parser.add_argument('--partition', default='hash',
+                        choices=['hash', 'range'],
+                        help='How students are assigned to --shards')
+    parser.add_argument('--range-size', type=int, default=1000000,
+                        help='IDs per shard with --partition range')
+    parser.add_argument('--shard-processes', type=int,
+                        help='Processes querying shards (default: one per '
+                             'shard)')
+    args = parser.parse_args()
+
+    options = dict(durability=args.durability,
+                   commitWindow=args.commit_window,
+                   maxGroupSize=args.max_group_size,
+                   readPoolSize=args.read_pool_size,
+                   statsLog=args.stats_log,
+                   statsInterval=args.stats_interval,
+                   compressAbove=(args.compress_above 
+                                  if args.compress_above >= 0 else None),
+                   profile=args.profile)
+    if args.replica:
+        options['replica'] = True
+    if args.shards:
+        ll = ShardedLogicLayer(args.shards, args.partition, args.range_size,
+                               args.shard_processes, **options)
+    else:
+        ll = LogicLayer(args.db, **options)
+    print('Storage profile %s: %s' % (args.profile, 
+                                      json.dumps(ll.storageSettings)),
+          file=sys.stderr)
+    if args.serve_async:
+        ll.ServeAsync(args.host, args.port, args.workers)
+    else:
+        ll.ConnectUI(args.host, args.port)
+        ll.WaitForMessages()
@@ -0,0 +1,376 @@
+import sys
+import zlib
+import array
+import struct
+import itertools
+
+
+# Every message is preceded by its size as a little-endian 32-bit integer.
+# The top bit of the size is set when the message body is zlib-compressed.
+HEADER = struct.Struct('<I')
+COMPRESSED = 0x80000000
+
+# Replies to requests that carry a 'reqID' start with that ID, or with the
+# negated ID for a reply reporting that the request failed. The ID is never
+# compressed, so a compressed body can be sent again for another request.
+REQUEST_ID = struct.Struct('<q')
+TAGGED_HEADER = struct.Struct('<Iq')
+
+# zlib level for compressed messages, favouring speed over size
+COMPRESS_LEVEL = 1
+
+
+def EncodeMessage(payload, reqID=None, compressAbove=None):
+    """
+    Return a message preceded by its size, ready to send.
+
+    INPUT:
+      payload       - Bytes-like message body
+      reqID         - Request ID to tag the message with (see SplitRequestID)
+      compressAbove - Compress messages with a body of at least this many 
+                      bytes (None to never compress), for peers that agreed
+                      to it (see LogicLayer.Negotiate)
+    """
+
+    return FrameMessage(*EncodeBody(payload, compressAbove), reqID)
+
+
+def EncodeBody(payload, compressAbove=None):
+    """
+    Return the body of a message and whether it is compressed, for 
+    FrameMessage (see EncodeMessage).
+    """
+
+    if compressAbove is not None and len(payload) >= compressAbove:
+        return zlib.compress(payload, COMPRESS_LEVEL), True
+    return payload, False
+
+
+def FrameMessage(body, compressed=False, reqID=None):
+    """
+    Return a body from EncodeBody preceded by its size and any request ID,
+    ready to send.
+    """
+
+    flag = COMPRESSED if compressed else 0
+    if reqID is None:
+        return HEADER.pack(len(body) | flag) + body
+    return (TAGGED_HEADER.pack((len(body) + REQUEST_ID.size) | flag, reqID) 
+            + body)
+
+
+def SendMessage(sock, payload, reqID=None, compressAbove=None):
+    """
+    Send a message preceded by its size.
+
+    The header and payload go out in a single sendall so the pair is never
+    split across Nagle-delayed packets or interleaved with other messages.
+
+    INPUT:
+      sock          - Socket (or anything with sendall) to send on
+      payload       - Bytes-like message body
+      reqID         - Request ID to tag the message with (see SplitRequestID)
+      compressAbove - Size from which to compress (see EncodeMessage)
+    """
+
+    sock.sendall(EncodeMessage(payload, reqID, compressAbove))
+
+
+def SplitHeader(header):
+    """
+    Return the body size given in a message header and whether the body is
+    compressed.
+    """
+
+    size = HEADER.unpack(header)[0]
+    return size & ~COMPRESSED, bool(size & COMPRESSED)
+
+
+def DecompressBody(body, maxSize=1 << 31):
+    """
+    Decompress the body of a compressed message.
+    """
+
+    decompressor = zlib.decompressobj()
+    msg = decompressor.decompress(body, maxSize)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError('Bad compressed message')
+    return msg
+
+
+def SplitRequestID(msg):
+    """
+    Split a tagged message into its request ID and a memoryview of its body.
+    """
+
+    return REQUEST_ID.unpack_from(msg)[0], memoryview(msg)[REQUEST_ID.size:]
+
+
+def ReceiveExactly(sock, view):
+    """
+    Fill a memoryview from the socket.
+
+    INPUT:
+      sock - Socket to read from
+      view - Writable memoryview to fill
+
+    OUTPUT:
+      Number of bytes received, less than len(view) only if the connection
+      closed
+    """
+
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            break
+        received += count
+    return received
+
+
+def ReceiveMessage(sock, tagged=False):
+    """
+    Receive one length-prefixed message.
+
+    The body is read straight into a single preallocated buffer, so large
+    messages are received in one pass without concatenating chunks. 
+    Compressed messages are decompressed.
+
+    INPUT:
+      sock   - Socket to read from
+      tagged - Whether messages start with a request ID (see REQUEST_ID)
+
+    OUTPUT:
+      msg - Bytes-like message body, or None if the connection closed 
+            before a new message started
+    """
+
+    header = bytearray(HEADER.size)
+    received = ReceiveExactly(sock, memoryview(header))
+    if received == 0:
+        return None
+    if received < HEADER.size:
+        raise ConnectionError('Connection closed inside a message header')
+
+    msgSize, compressed = SplitHeader(header)
+    msg = bytearray(msgSize)
+    if ReceiveExactly(sock, memoryview(msg)) < msgSize:
+        raise ConnectionError('Connection closed inside a message')
+    if compressed and tagged:
+        return (msg[:REQUEST_ID.size] + 
+                DecompressBody(memoryview(msg)[REQUEST_ID.size:]))
+    if compressed:
+        return DecompressBody(msg)
+    return msg
+
+
+# Compact columnar encoding of a table:
+#   header      - magic, format version, number of columns, number of rows
+#   descriptors - per column: type code, name length, UTF-8 name
+#   blocks      - per column, starting on an 8-byte boundary: little-endian 
+#                 int64 values for integer columns, or n+1 uint32 offsets 
+#                 followed by the concatenated UTF-8 values for text columns
+COLUMNAR_MAGIC = b'STDC'
+COLUMNAR_VERSION = 1
+COLUMNAR_HEADER = struct.Struct('<4sBHI')
+COLUMN_DESCRIPTOR = struct.Struct('<cB')
+INT_COLUMN = b'i'
+TEXT_COLUMN = b's'
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def _Padding(size):
+    return b'\0' * (-size % 8)
+
+
+def _EncodeText(values):
+    """
+    Return the offsets and data blocks for a text column.
+    """
+
+    values = ['' if value is None else str(value) for value in values]
+    text = ''.join(values)
+    data = text.encode('utf-8')
+    if len(data) == len(text):
+        # Plain ASCII: byte offsets are character offsets
+        lengths = map(len, values)
+    else:
+        encoded = [value.encode('utf-8') for value in values]
+        data = b''.join(encoded)
+        lengths = map(len, encoded)
+
+    offsets = array.array('I', [0])
+    offsets.extend(itertools.accumulate(lengths))
+    if not LITTLE_ENDIAN:
+        offsets.byteswap()
+    return [offsets.tobytes(), data]
+
+
+def EncodeColumnar(names, columns):
+    """
+    Encode a table in the compact columnar format.
+
+    Columns holding only integers are stored as packed int64 arrays; any 
+    other column is stored as text, with None written as an empty string.
+
+    INPUT:
+      names   - List of column names
+      columns - List of columns, each a sequence of values
+
+    OUTPUT:
+      payload - Encoded table (bytes)
+    """
+
+    numRows = len(columns[0]) if columns else 0
+    parts = [COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION,
+                                  len(names), numRows)]
+    blocks = []
+
+    for name, values in zip(names, columns):
+        if len(values) != numRows:
+            raise ValueError('Column %r has %d rows, expected %d'
+                             % (name, len(values), numRows))
+
+        try:
+            ints = array.array('q', values)
+        except (TypeError, OverflowError):
+            typeCode = TEXT_COLUMN
+            blocks.append(_EncodeText(values))
+        else:
+            typeCode = INT_COLUMN
+            if not LITTLE_ENDIAN:
+                ints.byteswap()
+            blocks.append([ints.tobytes()])
+
+        encodedName = name.encode('utf-8')
+        parts.append(COLUMN_DESCRIPTOR.pack(typeCode, len(encodedName)))
+        parts.append(encodedName)
+
+    size = sum(len(part) for part in parts)
+    for block in blocks:
+        parts.append(_Padding(size))
+        size += len(parts[-1])
+        parts += block
+        size += sum(len(part) for part in block)
+
+    return b''.join(parts)
+
+
+class TextColumn:
+    """
+    Read-only sequence of strings from a columnar payload, decoded on access.
+
+    INPUT:
+      offsets - Sequence of n+1 offsets into data
+      data    - memoryview of the concatenated UTF-8 values
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('TextColumn index out of range')
+        start = self.offsets[index]
+        return str(self.data[start:self.offsets[index + 1]], 'utf-8')
+
+    def tolist(self):
+        """
+        Decode every value at once.
+        """
+
+        offsets = self.offsets.tolist()
+        text = str(self.data, 'utf-8')
+        if len(text) != len(self.data):
+            # Offsets count bytes, so slice the raw bytes when any value has
+            # multi-byte characters
+            raw = self.data.tobytes()
+            return [str(raw[start:end], 'utf-8')
+                    for start, end in zip(offsets, offsets[1:])]
+        return [text[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+class ColumnarTable:
+    """
+    Lazily decoded view of a table encoded with EncodeColumnar.
+
+    Only the header is parsed up front. Integer columns are exposed as 
+    memoryviews over the payload and text values are decoded when accessed, 
+    so no per-row objects are built unless they are asked for.
+
+    INPUT:
+      payload - Encoded table (bytes-like)
+    """
+
+    def __init__(self, payload):
+        view = memoryview(payload)
+        magic, formatVersion, numColumns, self.numRows = \
+            COLUMNAR_HEADER.unpack_from(view)
+        if magic != COLUMNAR_MAGIC or formatVersion != COLUMNAR_VERSION:
+            raise ValueError('Not a columnar payload')
+
+        pos = COLUMNAR_HEADER.size
+        descriptors = []
+        for i in range(numColumns):
+            typeCode, nameSize = COLUMN_DESCRIPTOR.unpack_from(view, pos)
+            pos += COLUMN_DESCRIPTOR.size
+            descriptors.append((str(view[pos:pos + nameSize], 'utf-8'),
+                                typeCode))
+            pos += nameSize
+
+        self.columns = [name for name, typeCode in descriptors]
+        self.data = {}
+        for name, typeCode in descriptors:
+            pos += -pos % 8
+            if typeCode == INT_COLUMN:
+                end = pos + 8 * self.numRows
+                self.data[name] = self._Array(view[pos:end], 'q')
+            else:
+                end = pos + 4 * (self.numRows + 1)
+                offsets = self._Array(view[pos:end], 'I')
+                pos, end = end, end + offsets[-1]
+                self.data[name] = TextColumn(offsets, view[pos:end])
+            pos = end
+
+    @staticmethod
+    def _Array(view, typeCode):
+        if LITTLE_ENDIAN:
+            return view.cast(typeCode)
+        values = array.array(typeCode, view.tobytes())
+        values.byteswap()
+        return values
+
+    def __len__(self):
+        return self.numRows
+
+    def Column(self, name):
+        """
+        Return one column as a sequence.
+        """
+
+        return self.data[name]
+
+    def Row(self, index):
+        """
+        Return one row as a tuple.
+        """
+
+        return tuple(self.data[name][index] for name in self.columns)
+
+    def Rows(self):
+        """
+        Decode the whole table into a list of row tuples.
+        """
+
+        return list(zip(*[self.data[name].tolist() for name in self.columns]))
+
+    def __iter__(self):
+        return iter(self.Rows())
@@ -0,0 +1,248 @@
+import unittest
+
+import io
+import os
+import socket
+import pickle
+import sqlite3
+import threading
+
+import Logic
+import Client
+import Protocol
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dbname = 'test.db'
+        self.conn = sqlite3.connect(self.dbname)
+        self.c = self.conn.cursor()
+        self.c.execute('''CREATE TABLE students (id INTEGER PRIMARY KEY, 
+                          first_name, last_name)''')
+
+        self.c.execute("INSERT INTO students VALUES (null, 'Alyssa', 'Batula')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Kaylee', 'Frye')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Harry', 'Potter')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Jon', 'Snow')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Clara', 'Oswald')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Anthony', 'Stark')")
+
+        self.conn.commit()
+
+        self.Logic = Logic.LogicLayer(self.dbname)
+        self.serverThread = threading.Thread(target=self.Logic.ServeAsync,
+                                             kwargs={'TCP_PORT':0})
+        self.serverThread.start()
+        self.assertTrue(self.Logic.serverReady.wait(5), 'Server did not start')
+        self.client = Client.StudentClient(*self.Logic.serverAddress)
+
+
+    def tearDown(self):
+
+        self.client.Close()
+        self.Logic.StopServer()
+        self.serverThread.join(5)
+        self.conn.close()
+        os.remove(self.dbname)
+
+
+    def test_Pipelined(self):
+
+        # Nothing waits for a reply until every request has been sent
+        adds = [self.client.AddStudent('Student', str(i)) for i in range(100)]
+        update = self.client.UpdateStudent(5, 'Oswin', 'Oswald')
+        delete = self.client.DeleteStudent(42)
+        students = self.client.GetStudents()
+
+        self.assertEqual([add.result(5) for add in adds],
+                         list(range(7, 107)))
+        self.assertEqual(update.result(5), 1)
+        self.assertEqual(delete.result(5), 1)
+
+        rows = students.result(5)
+        self.assertEqual(len(rows), 105)
+        self.assertEqual(rows[4], (5, 'Oswin', 'Oswald'))
+
+
+    def test_Errors(self):
+
+        # A failed request is answered with an error and the requests 
+        # around it are carried out as usual
+        students = self.client.GetStudents()
+        search = self.client.SearchStudents(sortBy='age')
+        export = self.client.ExportStudents(io.BytesIO(), chunkSize=0)
+        bogus = self.client.Request('Bogus')
+        count = self.client.CountStudents()
+
+        self.assertEqual(len(students.result(5)), 6)
+        with self.assertRaisesRegex(Client.RequestError, 
+                                    "ValueError: Unknown sort order 'age'"):
+            search.result(5)
+        with self.assertRaisesRegex(Client.RequestError, 'chunkSize'):
+            export.result(5)
+        with self.assertRaisesRegex(Client.RequestError, 
+                                    "Unknown command 'Bogus'"):
+            bogus.result(5)
+        self.assertEqual(count.result(5), 6)
+
+        stats = self.client.GetStats().result(5)['commands']
+        self.assertEqual(stats['SearchStudents']['errors'], 1)
+
+
+    def test_Columnar(self):
+
+        table = self.client.SearchStudents(fmt='columnar', lastName='S',
+                                           sortBy='last_name').result(5)
+        self.assertEqual(table.Column('ID').tolist(), [4, 6])
+        self.assertEqual(table.Row(1), (6, 'Anthony', 'Stark'))
+
+
+    def test_Batch(self):
+
+        ops = [{'cmd':'DeleteStudent', 'data':{'ID':1}},
+               {'cmd':'DeleteStudent', 'data':{'ID':1}}]
+        self.assertEqual(self.client.Batch(ops).result(5), [1, 0])
+
+        # A failed batch is rolled back and raises like any failed request
+        ops = [{'cmd':'DeleteStudent', 'data':{'ID':2}},
+               {'cmd':'RenameStudent', 'data':{'ID':3}}]
+        with self.assertRaises(Client.RequestError):
+            self.client.Batch(ops).result(5)
+        self.assertEqual(len(self.client.GetStudents().result(5)), 5)
+
+
+    def test_Compression(self):
+
+        self.assertEqual(self.client.compressAbove, 16384)
+
+        # Both the request and the reply are large enough to be compressed
+        ops = [{'cmd':'AddStudent',
+                'data':{'values':{'first_name':'Student', 
+                                  'last_name':str(i)}}} for i in range(2000)]
+        self.assertEqual(len(self.client.Batch(ops).result(5)), 2000)
+        rows = self.client.GetStudents().result(5)
+        self.assertEqual(len(rows), 2006)
+        self.assertEqual(rows[-1], (2006, 'Student', '1999'))
+
+        # A repeated reply is sent from the cache as it was compressed
+        self.assertEqual(self.client.GetStudents().result(5), rows)
+        stats = self.client.GetStats().result(5)['compression']
+        self.assertEqual(stats['replies'], 1)
+        self.assertLess(stats['bytesAfter'], stats['bytesBefore'])
+        self.assertEqual(self.Logic.replyCache.hits, 1)
+
+        with Client.StudentClient(*self.Logic.serverAddress,
+                                  compression=False) as client:
+            self.assertIsNone(client.compressAbove)
+            self.assertEqual(client.GetStudents().result(5), rows)
+
+
+    def test_Counts(self):
+
+        self.assertEqual(self.client.CountStudents().result(5), 6)
+        self.assertEqual(self.client.CountByName('first_name', 
+                                                 prefix='A').result(5),
+                         [('A', 2)])
+        self.assertEqual(self.client.CountDuplicates().result(5),
+                         {'names':0, 'students':0})
+
+
+    def test_Subscribe(self):
+
+        events = []
+        received = threading.Condition()
+
+        def OnEvent(event):
+            with received:
+                events.append(event)
+                received.notify()
+
+        subscription = self.client.Subscribe(OnEvent)
+        with received:
+            self.assertTrue(received.wait_for(lambda: events, 5))
+
+        # Another client's changes are pushed without asking
+        with Client.StudentClient(*self.Logic.serverAddress) as other:
+            other.UpdateStudent(3, 'Harold', 'Potter').result(5)
+        with received:
+            self.assertTrue(received.wait_for(
+                lambda: events[-1]['version'] == 1, 5))
+        changes = [change for event in events for change in event['changes']]
+        self.assertEqual(changes, [(1, 'update', 3, 'Harold', 'Potter')])
+
+        self.assertEqual(self.client.Unsubscribe().result(5), 1)
+        self.assertIsNone(subscription.result(5))
+
+
+    def test_ExportStudents(self):
+
+        f = io.BytesIO()
+        export = self.client.ExportStudents(f, chunkSize=4)
+        students = self.client.GetStudents()
+        self.assertIsNone(export.result(5))
+        self.assertEqual(len(students.result(5)), 6)
+        self.assertEqual(f.getvalue().decode('utf-8').splitlines(),
+                         ['ID,First Name,Last Name', '1,Alyssa,Batula',
+                          '2,Kaylee,Frye', '3,Harry,Potter', '4,Jon,Snow',
+                          '5,Clara,Oswald', '6,Anthony,Stark'])
+
+        f = io.BytesIO()
+        self.client.ExportStudents(f, fmt='columnar', chunkSize=4).result(5)
+        f.seek(0)
+        rows = []
+        for size in iter(lambda: f.read(Protocol.HEADER.size), b''):
+            chunk = f.read(Protocol.HEADER.unpack(size)[0])
+            rows += Protocol.ColumnarTable(chunk).Rows()
+        self.assertEqual(rows, self.client.GetStudents().result(5))
+
+
+    def test_StreamStudents(self):
+
+        batches = []
+        stream = self.client.StreamStudents(batches.append, batchSize=4)
+        self.assertIsNone(stream.result(5))
+        self.assertEqual([len(batch['students']) for batch in batches], 
+                         [4, 2])
+        self.assertEqual(batches[0]['students'] + batches[1]['students'],
+                         self.client.GetStudents().result(5))
+
+
+class TestClientOutOfOrder(unittest.TestCase):
+
+    def test_OutOfOrderReplies(self):
+
+        listener = socket.create_server(('127.0.0.1', 0))
+
+        # Minimal server answering three requests in reverse order
+        def Serve():
+            sock, addr = listener.accept()
+            sock.recv(len(b'Hello Logic'))
+            sock.sendall(b'Hello UI')
+            msgs = [pickle.loads(Protocol.ReceiveMessage(sock))
+                    for i in range(3)]
+            for msg in reversed(msgs):
+                Protocol.SendMessage(sock, pickle.dumps(msg['data']['ID']),
+                                     msg['reqID'])
+            sock.close()
+
+        server = threading.Thread(target=Serve)
+        server.start()
+
+        client = Client.StudentClient(*listener.getsockname(),
+                                      compression=False)
+        futures = [client.DeleteStudent(id) for id in (10, 20, 30)]
+        self.assertEqual([f.result(5) for f in futures], [10, 20, 30])
+
+        # Requests made once the connection has dropped fail
+        with self.assertRaises(ConnectionError):
+            client.DeleteStudent(40).result(5)
+
+        server.join()
+        client.Close()
+        listener.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
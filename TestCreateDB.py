@@ -0,0 +1,62 @@
+import unittest
+
+import os
+import sqlite3
+
+import Logic
+import CreateDB
+
+
+class TestCreateDB(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dbname = 'test.db'
+        self.conn = CreateDB.CreateDatabase(self.dbname, 1000, seed=1)
+
+
+    def tearDown(self):
+
+        self.conn.close()
+        os.remove(self.dbname)
+
+
+    def test_Students(self):
+
+        rows = self.conn.execute('SELECT * FROM students').fetchall()
+        self.assertEqual(len(rows), 1000)
+        self.assertEqual(rows[:2], [(1, 'Alyssa', 'Batula'),
+                                    (2, 'Kaylee', 'Frye')])
+
+        # The same seed gives the same students
+        self.assertEqual([(f, l) for id, f, l in rows],
+                         list(CreateDB.GenerateStudents(1000, seed=1)))
+        self.assertNotEqual(list(CreateDB.GenerateStudents(1000, seed=1)),
+                            list(CreateDB.GenerateStudents(1000, seed=2)))
+
+        # Common names are shared by many more students than rare ones
+        counts = dict(self.conn.execute('''SELECT last_name, count(*) 
+                                           FROM students GROUP BY 1'''))
+        self.assertGreater(counts['Smith'], 3 * counts.get('Kowalski', 0))
+
+
+    def test_Schema(self):
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.conn.execute('INSERT INTO students VALUES (null, ?, null)',
+                              ('Luke',))
+
+        indexes = {row[0] for row in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertTrue({'students_last_first', 
+                         'students_first_last'} <= indexes)
+        self.assertEqual(self.conn.execute('PRAGMA user_version').fetchone(),
+                         (len(Logic.SCHEMA_MIGRATIONS),))
+
+        logic = Logic.LogicLayer(self.dbname)
+        self.assertEqual(len(logic.GetStudents(asDataFrame=False)), 1000)
+        logic.Close()
+
+
+if __name__ == '__main__':
+    unittest.main()
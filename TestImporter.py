@@ -0,0 +1,100 @@
+import unittest
+
+import os
+import json
+import sqlite3
+
+import Logic
+import Importer
+
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dbname = 'test.db'
+        self.conn = sqlite3.connect(self.dbname)
+        self.c = self.conn.cursor()
+        self.c.execute('''CREATE TABLE students (id INTEGER PRIMARY KEY,
+                          first_name, last_name)''')
+
+        self.c.execute("INSERT INTO students VALUES (null, 'Alyssa', 'Batula')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Kaylee', 'Frye')")
+
+        self.conn.commit()
+
+        self.Logic = Logic.LogicLayer(self.dbname)
+
+
+    def tearDown(self):
+
+        self.Logic.Close()
+        self.conn.close()
+        os.remove(self.dbname)
+
+
+    def WriteFile(self, path, text):
+
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        self.addCleanup(os.remove, path)
+
+
+    def test_ImportCSV(self):
+
+        self.WriteFile('test_import.csv',
+                       'ID,First Name,Last Name\n'
+                       '1,Harry,Potter\n2,Jon,Snow\n3,Clara,Oswald\n')
+        progress = []
+        count = Importer.ImportFile(self.Logic, 'test_import.csv',
+                                    chunkSize=2, OnProgress=progress.append)
+
+        self.assertEqual(count, 3)
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual(self.Logic.GetStudents(asDataFrame=False)[2:],
+                         [(3, 'Harry', 'Potter'), (4, 'Jon', 'Snow'),
+                          (5, 'Clara', 'Oswald')])
+
+
+    def test_ImportJSONLines(self):
+
+        self.WriteFile('test_import.jsonl',
+                       json.dumps({'first_name':'Zoë', 'last_name':'Núñez'})
+                       + '\n\n' +
+                       json.dumps({'First Name':'Jon', 'Last Name':'Snow'}))
+        count = Importer.ImportFile(self.Logic, 'test_import.jsonl')
+
+        self.assertEqual(count, 2)
+        self.assertEqual(self.Logic.GetStudents(asDataFrame=False)[2:],
+                         [(3, 'Zoë', 'Núñez'), (4, 'Jon', 'Snow')])
+
+
+    def test_Resume(self):
+
+        self.WriteFile('test_import.csv',
+                       'first_name,last_name\n'
+                       'Harry,Potter\nJon,Snow\nClara,\nAnthony,Stark\n')
+        version = self.Logic.version
+        progress = []
+        with self.assertRaisesRegex(ValueError, 'Record 2 has no last name'):
+            Importer.ImportFile(self.Logic, 'test_import.csv', chunkSize=2,
+                                OnProgress=progress.append)
+
+        # The first chunk stays imported, the failed one is rolled back
+        self.assertEqual(progress, [2])
+        self.assertEqual(len(self.Logic.GetStudents(asDataFrame=False)), 4)
+
+        count = Importer.ImportFile(self.Logic, 'test_import.csv',
+                                    offset=3)
+        self.assertEqual(count, 1)
+        self.assertEqual(self.Logic.GetStudents(asDataFrame=False)[-1],
+                         (5, 'Anthony', 'Stark'))
+
+        # Clients following changes have to reload everything
+        reply = self.Logic.GetStudentsSince(version, self.Logic.epoch)
+        self.assertTrue(reply['reset'])
+        self.assertEqual(len(reply['students']), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,19 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 
 import os
+import sys
+import json
 import sqlite3
+import subprocess
 import pickle
 import socket
+import struct
+import threading
 import pandas as pd
 
 import Logic
+import Protocol
 
 class TestLogicDB(unittest.TestCase):
 
@@ -107,6 +113,415 @@ class TestLogicDB(unittest.TestCase):
         self.assertTrue(df.equals(expectedDF),
                         'Did not update student properly')
 
+
+    def test_Batch(self):
+
+        ops = [{'cmd':'AddStudent',
+                'data':{'values':{'first_name':'Luke',
+                                  'last_name':'Skywalker'}}},
+               {'cmd':'AddStudent',
+                'data':{'values':{'first_name':'Leia',
+                                  'last_name':'Organa'}}},
+               {'cmd':'UpdateStudent',
+                'data':{'ID':5, 'values':{'first_name':'Oswin',
+                                          'last_name':'Oswald'}}},
+               {'cmd':'UpdateStudent',
+                'data':{'ID':42, 'values':{'first_name':'Nobody',
+                                           'last_name':'Here'}}},
+               {'cmd':'DeleteStudent', 'data':{'ID':3}},
+               {'cmd':'DeleteStudent', 'data':{'ID':3}},
+               {'cmd':'DeleteStudent', 'data':{'ID':7}}]
+        results = self.Logic.Batch(ops)
+        df = self.Logic.GetStudents()
+
+        dfContents = [[1, 'Alyssa', 'Batula'],
+                      [2, 'Kaylee', 'Frye'],
+                      [4, 'Jon', 'Snow'],
+                      [5, 'Oswin', 'Oswald'],
+                      [6, 'Anthony', 'Stark'],
+                      [8, 'Leia', 'Organa']]
+        columns = ['ID', 'First Name', 'Last Name']
+        expectedDF = pd.DataFrame(data=dfContents, index=None, columns=columns)
+
+        self.assertEqual(results, [7, 8, 1, 0, 1, 0, 1])
+        self.assertTrue(df.equals(expectedDF), 'Did not apply batch properly')
+
+
+    def test_Batch_Rollback(self):
+
+        ops = [{'cmd':'AddStudent',
+                'data':{'values':{'first_name':'Luke',
+                                  'last_name':'Skywalker'}}},
+               {'cmd':'DeleteStudent', 'data':{'ID':3}},
+               {'cmd':'RenameStudent', 'data':{'ID':4}}]
+
+        with self.assertRaises(ValueError):
+            self.Logic.Batch(ops)
+        df = self.Logic.GetStudents()
+
+        self.assertEqual(df['ID'].tolist(), [1, 2, 3, 4, 5, 6],
+                         'Failed batch was not rolled back')
+
+
+    def test_GetStudentsRows(self):
+
+        rows = self.Logic.GetStudents(asDataFrame=False)
+        self.assertEqual(rows[:2], [(1, 'Alyssa', 'Batula'),
+                                    (2, 'Kaylee', 'Frye')])
+
+        # Serving rows never needs pandas
+        code = 'import sys, Logic; print("pandas" in sys.modules)'
+        logicDir = os.path.dirname(os.path.abspath(Logic.__file__))
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=logicDir)
+        self.assertEqual(output.strip(), b'False')
+
+
+    def test_GetStudentsPage(self):
+
+        df, cursor = self.Logic.GetStudentsPage(4)
+        self.assertEqual(df['ID'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(df.loc[2, 'Last Name'], 'Potter')
+
+        # Rows deleted before the cursor do not shift later pages
+        self.Logic.RemoveStudent(2)
+        df, cursor = self.Logic.GetStudentsPage(4, cursor)
+        self.assertEqual(df['ID'].tolist(), [5, 6])
+        self.assertIsNone(cursor)
+
+        df, cursor = self.Logic.GetStudentsPage(5)
+        df, cursor = self.Logic.GetStudentsPage(5, cursor)
+        self.assertEqual(len(df), 0)
+        self.assertIsNone(cursor)
+
+        # Every page is bounded
+        for pageSize in (0, -1, 2.5, None):
+            with self.assertRaises(ValueError):
+                self.Logic.GetStudentsPage(pageSize)
+
+
+    def test_SearchStudents(self):
+
+        self.Logic.AddStudent({'first_name':'Harriet', 'last_name':'Stark'})
+        self.Logic.AddStudent({'first_name':'Harry', 'last_name':'Stone'})
+
+        df = self.Logic.SearchStudents(lastName='St', sortBy='last_name')
+        self.assertEqual(df['ID'].tolist(), [6, 7, 8])
+
+        df = self.Logic.SearchStudents(firstName='Har', lastName='St')
+        self.assertEqual(df['First Name'].tolist(), ['Harriet', 'Harry'])
+
+        df = self.Logic.SearchStudents(firstName='Harry', match='exact',
+                                       sortBy='last_name', descending=True)
+        self.assertEqual(df['Last Name'].tolist(), ['Stone', 'Potter'])
+
+        df = self.Logic.SearchStudents(lastName='Star', match='exact')
+        self.assertEqual(len(df), 0)
+
+        df = self.Logic.SearchStudents(sortBy='first_name', limit=2)
+        self.assertEqual(df['First Name'].tolist(), ['Alyssa', 'Anthony'])
+
+        # Prefixes ending in characters without a simple successor
+        self.Logic.AddStudent({'first_name':'\ud7ff\ue000', 
+                               'last_name':'\U0010ffff'})
+        df = self.Logic.SearchStudents(firstName='\ud7ff')
+        self.assertEqual(df['ID'].tolist(), [9])
+        df = self.Logic.SearchStudents(lastName='\U0010ffff')
+        self.assertEqual(df['ID'].tolist(), [9])
+
+        with self.assertRaises(ValueError):
+            self.Logic.SearchStudents(lastName='St', sortBy='age')
+
+
+    def test_Counts(self):
+
+        self.Logic.AddStudent({'first_name':'Harry', 'last_name':'Potter'})
+        self.Logic.AddStudent({'first_name':'Harry', 'last_name':'Potter'})
+        self.Logic.AddStudent({'first_name':'Arya', 'last_name':'Stark'})
+
+        self.assertEqual(self.Logic.CountStudents(), 9)
+        self.assertEqual(self.Logic.CountByName(),
+                         [('B', 1), ('F', 1), ('O', 1), ('P', 3), ('S', 3)])
+        self.assertEqual(self.Logic.CountByName(length=2, prefix='S'),
+                         [('Sn', 1), ('St', 2)])
+        self.assertEqual(self.Logic.CountByName('first_name', prefix='Q'), [])
+        self.assertEqual(self.Logic.CountDuplicates(),
+                         {'names':1, 'students':3})
+
+        with self.assertRaises(ValueError):
+            self.Logic.CountByName('id')
+
+
+    def test_MigrateSchema(self):
+
+        self.Logic.cursor.execute('PRAGMA user_version')
+        self.assertEqual(self.Logic.cursor.fetchone()[0],
+                         len(Logic.SCHEMA_MIGRATIONS))
+
+        # Running again on a migrated database changes nothing
+        Logic.LogicLayer(self.dbname)
+
+        self.Logic.cursor.execute('''EXPLAIN QUERY PLAN SELECT id FROM students
+                                     WHERE last_name >= ? AND last_name < ?
+                                     ORDER BY last_name, first_name, id''',
+                                  ('St', 'Su'))
+        plan = ' '.join(row[-1] for row in self.Logic.cursor.fetchall())
+        self.assertIn('INDEX students_last_first', plan)
+
+
+    def test_GroupCommit(self):
+
+        self.Logic = Logic.LogicLayer(self.dbname, durability='group',
+                                      commitWindow=0.2, maxGroupSize=8)
+        self.Logic.cursor.execute('PRAGMA journal_mode')
+        self.assertEqual(self.Logic.cursor.fetchone()[0], 'wal')
+
+        # Writes arriving together are committed together
+        barrier = threading.Barrier(12)
+        def Add(i):
+            barrier.wait()
+            self.Logic.AddStudent({'first_name':'Student', 
+                                   'last_name':str(i)})
+        threads = [threading.Thread(target=Add, args=(i,)) for i in range(12)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        committer = self.Logic.groupCommitter
+        self.assertEqual(committer.writes, 12)
+        self.assertLess(committer.commits, 12)
+        self.assertEqual(len(self.Logic.GetStudents()), 18)
+        self.assertEqual(self.Logic.version, 12)
+
+        # A failing write does not take the rest of its group with it
+        with self.assertRaises(ValueError):
+            self.Logic.Batch([{'cmd':'DeleteStudent', 'data':{'ID':1}},
+                              {'cmd':'RenameStudent', 'data':{'ID':2}}])
+        self.Logic.RemoveStudent(2)
+        self.assertEqual(self.Logic.GetStudents()['ID'].tolist()[:2], [1, 3])
+
+        self.Logic.Close()
+
+
+    def test_ReaderPool(self):
+
+        self.Logic = Logic.LogicLayer(self.dbname, readPoolSize=2)
+        pool = self.Logic.readerPool
+
+        self.Logic.AddStudent({'first_name':'Luke', 'last_name':'Skywalker'})
+        rows = self.Logic.GetStudents(asDataFrame=False)
+        self.assertEqual(rows[-1], (7, 'Luke', 'Skywalker'))
+        self.assertEqual(pool.Stats()['acquisitions'], 1)
+
+        # Readers are read-only
+        with pool.Connection() as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute('DELETE FROM students')
+
+        # A reader waits when every connection is busy
+        with pool.Connection(), pool.Connection():
+            reader = threading.Thread(target=self.Logic.SearchStudents,
+                                      kwargs={'lastName':'S'})
+            reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+        reader.join()
+        self.assertGreater(pool.Stats()['maxWait'], 0.05)
+
+        self.Logic.Close()
+
+
+    def test_Replica(self):
+
+        self.Logic = Logic.LogicLayer(self.dbname, replica=True)
+
+        self.Logic.Batch([{'cmd':'AddStudent',
+                           'data':{'values':{'first_name':'Luke',
+                                             'last_name':'Skywalker'}}},
+                          {'cmd':'UpdateStudent',
+                           'data':{'ID':1, 'values':{'first_name':'Leia',
+                                                     'last_name':'Batula'}}},
+                          {'cmd':'DeleteStudent', 'data':{'ID':2}}])
+        rows = self.Logic.GetStudents(asDataFrame=False)
+        self.assertEqual(rows[:2], [(1, 'Leia', 'Batula'), 
+                                    (3, 'Harry', 'Potter')])
+        self.assertEqual(rows[-1], (7, 'Luke', 'Skywalker'))
+
+        # Queries are answered from memory, so a write made behind the 
+        # logic layer's back is not seen until the next refresh
+        self.c.execute("INSERT INTO students VALUES (null, 'Arya', 'Stark')")
+        self.conn.commit()
+        self.assertEqual(len(self.Logic.SearchStudents(lastName='Stark')), 1)
+
+        # A bulk import copies just the students it added
+        self.Logic.ImportStudents([('Jon', 'Stark'), ('Sansa', 'Stark')])
+        rows = self.Logic.SearchStudents(lastName='Stark', asDataFrame=False)
+        self.assertEqual(rows, [(6, 'Anthony', 'Stark'), (9, 'Jon', 'Stark'),
+                                (10, 'Sansa', 'Stark')])
+        self.assertEqual(self.Logic.GetStats()['replica'],
+                         {'refreshes':1, 'changes':4})
+
+        with self.assertRaises(ValueError):
+            Logic.LogicLayer(self.dbname, replica=True, readPoolSize=2)
+
+        self.Logic.Close()
+
+
+    def test_Replica_Version(self):
+
+        self.Logic = Logic.LogicLayer(self.dbname, replica=True)
+        ApplyToReplica = self.Logic._ApplyToReplica
+        streamed = []
+
+        def ApplyAndRead(changes):
+            ApplyToReplica(changes)
+            # A query right after the replica is updated
+            streamed.extend(self.Logic.StreamStudents())
+
+        self.Logic._ApplyToReplica = ApplyAndRead
+        self.Logic.AddStudent({'first_name':'Luke', 'last_name':'Skywalker'})
+
+        # The new student is never labelled with the version before it
+        batch, = streamed
+        self.assertEqual(batch['version'], 0)
+        self.assertEqual(len(batch['students']), 7)
+        reply = self.Logic.GetStudentsSince(batch['version'], batch['epoch'])
+        self.assertEqual(reply['changes'], 
+                         [(1, 'insert', 7, 'Luke', 'Skywalker')])
+
+        self.Logic.Close()
+
+
+    def test_Profile(self):
+
+        self.Logic = Logic.LogicLayer(self.dbname, profile='read-heavy',
+                                      readPoolSize=1)
+        settings = self.Logic.GetStats()['storage']
+        self.assertEqual(settings['profile'], 'read-heavy')
+        self.assertEqual(settings['journal_mode'], 'wal')
+        self.assertEqual(settings['synchronous'], 'normal')
+        self.assertEqual(settings['cache_size'], -262144)
+        self.assertEqual(settings['temp_store'], 'memory')
+
+        with self.Logic.readerPool.Connection() as conn:
+            self.assertEqual(Logic.StorageSettings(conn)['cache_size'], 
+                             -262144)
+        self.Logic.Close()
+
+        # A durability mode wins over the profile
+        self.Logic = Logic.LogicLayer(self.dbname, profile='balanced',
+                                      durability='wal')
+        self.assertEqual(self.Logic.storageSettings['synchronous'], 'full')
+        self.Logic.Close()
+
+        with self.assertRaises(ValueError):
+            Logic.LogicLayer(self.dbname, profile='fast')
+
+
+    def test_Subscribe(self):
+
+        gate = threading.Event()
+        sent = []
+
+        class SlowSession:
+            compressAbove = None
+            def sendall(self, data):
+                gate.wait(5)
+                sent.append(data)
+
+        def Decode(data):
+            reqID, body = Protocol.SplitRequestID(data[4:])
+            self.assertEqual(reqID, 9)
+            return pickle.loads(body) if body else None
+
+        def WaitFor(Done):
+            for i in range(500):
+                if sent and Done(Decode(sent[-1])):
+                    break
+                threading.Event().wait(0.01)
+            return [Decode(data) for data in sent]
+
+        self.Logic.maxPendingEvents = 2
+        session = SlowSession()
+        self.Logic.Subscribe(session, 9)
+
+        # Writes go ahead while the subscriber is stuck, and changes to the
+        # same student are coalesced
+        self.Logic.UpdateStudent(1, {'first_name':'A', 'last_name':'B'})
+        self.Logic.UpdateStudent(1, {'first_name':'Aly', 'last_name':'Batula'})
+        self.Logic.RemoveStudent(2)
+        gate.set()
+
+        events = WaitFor(lambda last: last['version'] == 3)
+        self.assertEqual(events[0], {'epoch':self.Logic.epoch, 'since':0,
+                                     'version':0, 'changes':[]})
+        self.assertEqual(events[1]['since'], 0)
+        self.assertEqual(events[1]['version'], 3)
+        self.assertEqual(events[1]['changes'],
+                         [(2, 'update', 1, 'Aly', 'Batula'),
+                          (3, 'delete', 2, None, None)])
+
+        # Too many waiting changes become a reset
+        gate.clear()
+        for i in range(4):
+            self.Logic.AddStudent({'first_name':'Student', 
+                                   'last_name':str(i)})
+        gate.set()
+        events = WaitFor(lambda last: last['version'] == 7)
+        self.assertEqual(events[-1]['version'], 7)
+        self.assertTrue(events[-1]['reset'])
+
+        self.assertEqual(self.Logic.Unsubscribe(session), 1)
+        self.assertIsNone(WaitFor(lambda last: last is None)[-1])
+        self.assertEqual(self.Logic.subscriptions, [])
+
+
+    def test_GetStudentsSince(self):
+
+        reply = self.Logic.GetStudentsSince()
+        self.assertTrue(reply['reset'])
+        self.assertEqual(reply['students'][2], (3, 'Harry', 'Potter'))
+        self.assertEqual(len(reply['students']), 6)
+
+        version, epoch = reply['version'], reply['epoch']
+        self.Logic.AddStudent({'first_name':'Luke', 'last_name':'Skywalker'})
+        self.Logic.UpdateStudent(5, {'first_name':'Oswin',
+                                     'last_name':'Oswald'})
+        self.Logic.UpdateStudent(42, {'first_name':'Nobody',
+                                      'last_name':'Here'})
+        self.Logic.RemoveStudent(3)
+        reply = self.Logic.GetStudentsSince(version, epoch)
+
+        changes = [(version + 1, 'insert', 7, 'Luke', 'Skywalker'),
+                   (version + 2, 'update', 5, 'Oswin', 'Oswald'),
+                   (version + 3, 'delete', 3, None, None)]
+        self.assertFalse(reply['reset'])
+        self.assertEqual(reply['changes'], changes)
+        self.assertEqual(reply['version'], version + 3)
+
+        reply = self.Logic.GetStudentsSince(version + 2, epoch)
+        self.assertEqual(reply['changes'], changes[2:])
+
+        reply = self.Logic.GetStudentsSince(reply['version'], epoch)
+        self.assertEqual(reply['changes'], [])
+
+        # Versions from another server run are not trusted
+        reply = self.Logic.GetStudentsSince(version, 'other')
+        self.assertTrue(reply['reset'])
+
+
+    def test_GetStudentsSince_Truncated(self):
+
+        self.Logic = Logic.LogicLayer(self.dbname, changeLogSize=2)
+        epoch = self.Logic.epoch
+        self.Logic.Batch([{'cmd':'DeleteStudent', 'data':{'ID':id}}
+                          for id in (1, 2, 3)])
+
+        self.assertTrue(self.Logic.GetStudentsSince(0, epoch)['reset'])
+        reply = self.Logic.GetStudentsSince(1, epoch)
+        self.assertEqual(reply['changes'], [(2, 'delete', 2, None, None),
+                                            (3, 'delete', 3, None, None)])
+        self.assertEqual(reply['version'], 3)
+
         
 class TestLogicConnection(unittest.TestCase):
     
@@ -154,6 +569,33 @@ class TestLogicConnection(unittest.TestCase):
 
     def test_ProcessMessage_Get(self):
 
+        rows = [(1, 'Alyssa', 'Batula'),
+                (2, 'Kaylee', 'Frye'),
+                (3, 'Harry', 'Potter'),
+                (4, 'Jon', 'Snow'),
+                (5, 'Clara', 'Oswald'),
+                (6, 'Anthony', 'Stark')]
+        reply = pickle.dumps(rows)
+        expectedReply = struct.pack('<i', len(reply)) + reply
+
+        msgdict = {'cmd':'GetStudents'}
+        sendmsg = pickle.dumps(msgdict)
+
+        TCP_IP = '127.0.0.1'
+        TCP_PORT=5005
+
+        with patch('Logic.socket.socket') as mock_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            mock_socket.return_value.accept.return_value = (sock, TCP_IP)
+            self.Logic = Logic.LogicLayer(self.dbname)
+            self.Logic.ConnectUI(TCP_IP=TCP_IP, TCP_PORT=TCP_PORT)
+            self.Logic.ProcessMessage(sendmsg)
+            
+            self.Logic.clientSock.sendall.assert_called_once_with(expectedReply)
+            
+
+    def test_ProcessMessage_GetDataFrame(self):
+
         dfContents = [[1, 'Alyssa', 'Batula'],
                       [2, 'Kaylee', 'Frye'],
                       [3, 'Harry', 'Potter'],
@@ -162,9 +604,8 @@ class TestLogicConnection(unittest.TestCase):
                       [6, 'Anthony', 'Stark']]
         columns = ['ID', 'First Name', 'Last Name']
         expectedDF = pd.DataFrame(data=dfContents, index=None, columns=columns)
-        expectedReply = pickle.dumps(expectedDF)
 
-        msgdict = {'cmd':'GetStudents'}
+        msgdict = {'cmd':'GetStudents', 'format':'dataframe'}
         sendmsg = pickle.dumps(msgdict)
 
         TCP_IP = '127.0.0.1'
@@ -176,9 +617,34 @@ class TestLogicConnection(unittest.TestCase):
             self.Logic = Logic.LogicLayer(self.dbname)
             self.Logic.ConnectUI(TCP_IP=TCP_IP, TCP_PORT=TCP_PORT)
             self.Logic.ProcessMessage(sendmsg)
-            
-            self.Logic.clientSock.sendall.assert_called_once_with(expectedReply)
-            
+
+            reply = self.Logic.clientSock.sendall.call_args[0][0]
+            df = pickle.loads(reply[4:])
+            self.assertTrue(df.equals(expectedDF), 'Returned incorrect DataFrame')
+
+
+    def test_ProcessMessage_GetColumnar(self):
+
+        msgdict = {'cmd':'SearchStudents', 'format':'columnar',
+                   'data':{'lastName':'S', 'sortBy':'last_name'}}
+        sendmsg = pickle.dumps(msgdict)
+
+        TCP_IP = '127.0.0.1'
+        TCP_PORT=5005
+
+        with patch('Logic.socket.socket') as mock_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            mock_socket.return_value.accept.return_value = (sock, TCP_IP)
+            self.Logic = Logic.LogicLayer(self.dbname)
+            self.Logic.ConnectUI(TCP_IP=TCP_IP, TCP_PORT=TCP_PORT)
+            self.Logic.ProcessMessage(sendmsg)
+
+            reply = self.Logic.clientSock.sendall.call_args[0][0]
+            table = Protocol.ColumnarTable(reply[4:])
+            self.assertEqual(table.columns, ['ID', 'First Name', 'Last Name'])
+            self.assertEqual(table.Rows(), [(4, 'Jon', 'Snow'),
+                                            (6, 'Anthony', 'Stark')])
+
 
     def test_ProcessMessage_Add(self):
 
@@ -285,5 +751,411 @@ class TestLogicConnection(unittest.TestCase):
                             'Did not remove student properly')
 
 
+    def test_ProcessMessage_Cache(self):
+
+        TCP_IP = '127.0.0.1'
+        TCP_PORT=5005
+
+        with patch('Logic.socket.socket') as mock_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            mock_socket.return_value.accept.return_value = (sock, TCP_IP)
+            self.Logic = Logic.LogicLayer(self.dbname, cacheSize=2)
+            self.Logic.ConnectUI(TCP_IP=TCP_IP, TCP_PORT=TCP_PORT)
+
+            getmsg = pickle.dumps({'cmd':'GetStudents'})
+            self.Logic.ProcessMessage(getmsg)
+            self.Logic.ProcessMessage(getmsg)
+            first, second = self.Logic.clientSock.sendall.call_args_list
+            self.assertEqual(first, second)
+            self.assertEqual(self.Logic.replyCache.hits, 1)
+            self.assertEqual(self.Logic.replyCache.misses, 1)
+
+            # A write makes the cached reply stale
+            self.Logic.ProcessMessage(pickle.dumps(
+                {'cmd':'DeleteStudent', 'data':{'ID':3}}))
+            self.Logic.ProcessMessage(getmsg)
+            reply = self.Logic.clientSock.sendall.call_args[0][0]
+            self.assertEqual(len(pickle.loads(reply[4:])), 5)
+            self.assertEqual(self.Logic.replyCache.misses, 2)
+
+            # Only the two most recently used replies are kept
+            for pageSize in (1, 2, 1):
+                self.Logic.ProcessMessage(pickle.dumps(
+                    {'cmd':'GetStudentsPage', 'data':{'pageSize':pageSize}}))
+            self.Logic.ProcessMessage(pickle.dumps({'cmd':'GetCacheStats'}))
+            reply = self.Logic.clientSock.sendall.call_args[0][0]
+            self.assertEqual(pickle.loads(reply[4:]),
+                             {'hits':2, 'misses':4, 'entries':2,
+                              'maxEntries':2})
+
+
+    def test_ProcessMessage_Export(self):
+
+        TCP_IP = '127.0.0.1'
+        TCP_PORT=5005
+
+        with patch('Logic.socket.socket') as mock_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            mock_socket.return_value.accept.return_value = (sock, TCP_IP)
+            self.Logic = Logic.LogicLayer(self.dbname)
+            self.Logic.ConnectUI(TCP_IP=TCP_IP, TCP_PORT=TCP_PORT)
+            self.Logic.ProcessMessage(pickle.dumps(
+                {'cmd':'ExportStudents', 'data':{'chunkSize':4}}))
+
+            chunks = [call[0][0][4:] for call in 
+                      self.Logic.clientSock.sendall.call_args_list]
+            self.assertEqual(chunks, 
+                             [b'ID,First Name,Last Name\r\n',
+                              b'1,Alyssa,Batula\r\n2,Kaylee,Frye\r\n'
+                              b'3,Harry,Potter\r\n4,Jon,Snow\r\n',
+                              b'5,Clara,Oswald\r\n6,Anthony,Stark\r\n',
+                              b''])
+
+
+    def test_ProcessMessage_Stream(self):
+
+        TCP_IP = '127.0.0.1'
+        TCP_PORT=5005
+
+        with patch('Logic.socket.socket') as mock_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            mock_socket.return_value.accept.return_value = (sock, TCP_IP)
+            self.Logic = Logic.LogicLayer(self.dbname)
+            self.Logic.ConnectUI(TCP_IP=TCP_IP, TCP_PORT=TCP_PORT)
+            self.Logic.AddStudent({'first_name':'Luke', 
+                                   'last_name':'Skywalker'})
+            self.Logic.ProcessMessage(pickle.dumps(
+                {'cmd':'StreamStudents', 'data':{'batchSize':4}}))
+
+            chunks = [call[0][0][4:] for call in 
+                      self.Logic.clientSock.sendall.call_args_list]
+            self.assertEqual(chunks[-1], b'')
+            batches = [pickle.loads(chunk) for chunk in chunks[:-1]]
+            self.assertEqual([len(batch['students']) for batch in batches],
+                             [4, 3])
+            self.assertEqual(batches[1]['students'][-1], 
+                             (7, 'Luke', 'Skywalker'))
+            self.assertEqual({batch['version'] for batch in batches}, {1})
+
+            # An empty table still sends the version
+            self.Logic.cursor.execute('DELETE FROM students')
+            self.Logic.conn.commit()
+            self.assertEqual(list(self.Logic.StreamStudents()),
+                             [{'epoch':self.Logic.epoch, 'version':1,
+                               'students':[]}])
+
+
+    def test_ProcessMessage_Error(self):
+
+        TCP_IP = '127.0.0.1'
+        TCP_PORT=5005
+
+        with patch('Logic.socket.socket') as mock_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            mock_socket.return_value.accept.return_value = (sock, TCP_IP)
+            self.Logic = Logic.LogicLayer(self.dbname)
+            self.Logic.ConnectUI(TCP_IP=TCP_IP, TCP_PORT=TCP_PORT)
+
+            # The connection stays open after a failed request
+            self.assertTrue(self.Logic.ProcessMessage(pickle.dumps(
+                {'cmd':'DeleteStudent', 'reqID':3})))
+            reply = self.Logic.clientSock.sendall.call_args[0][0]
+            reqID, body = Protocol.SplitRequestID(reply[4:])
+            self.assertEqual(reqID, -3)
+            self.assertEqual(pickle.loads(body), 
+                             {'ok':False, 'error':"KeyError: 'data'"})
+
+            # Without a reqID there is nothing to reply to
+            with patch('builtins.print') as mock_print:
+                self.assertTrue(self.Logic.ProcessMessage(pickle.dumps(
+                    {'cmd':'SearchStudents', 'data':{'match':'fuzzy'}})))
+                self.assertTrue(self.Logic.ProcessMessage(pickle.dumps(
+                    ['cmd', 'GetStudents'])))
+            self.assertEqual(self.Logic.clientSock.sendall.call_count, 1)
+            self.assertEqual(mock_print.call_count, 2)
+
+            self.assertTrue(self.Logic.ProcessMessage(pickle.dumps(
+                {'reqID':4})))
+            reply = self.Logic.clientSock.sendall.call_args[0][0]
+            reqID, body = Protocol.SplitRequestID(reply[4:])
+            self.assertEqual(reqID, -4)
+            self.assertEqual(pickle.loads(body)['error'], 
+                             'ValueError: Request is not a command dictionary')
+
+
+    def test_ProcessMessage_Stats(self):
+
+        TCP_IP = '127.0.0.1'
+        TCP_PORT=5005
+
+        with patch('Logic.socket.socket') as mock_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            mock_socket.return_value.accept.return_value = (sock, TCP_IP)
+            self.Logic = Logic.LogicLayer(self.dbname)
+            self.Logic.ConnectUI(TCP_IP=TCP_IP, TCP_PORT=TCP_PORT)
+
+            getmsg = pickle.dumps({'cmd':'GetStudents'})
+            self.Logic.ProcessMessage(getmsg)
+            self.Logic.ProcessMessage(getmsg)
+            getReply = self.Logic.clientSock.sendall.call_args[0][0]
+            self.Logic.ProcessMessage(pickle.dumps(
+                {'cmd':'DeleteStudent', 'data':{'ID':3}}))
+            self.Logic.ProcessMessage(pickle.dumps({'cmd':'GetStats'}))
+
+            reply = self.Logic.clientSock.sendall.call_args[0][0]
+            stats = pickle.loads(reply[4:])
+            self.assertEqual(stats['activeConnections'], 1)
+            self.assertEqual(stats['bytesOut'], 2 * len(getReply))
+            self.assertEqual(stats['cache']['hits'], 1)
+            self.assertIsNone(stats['pool'])
+
+            get = stats['commands']['GetStudents']
+            self.assertEqual(get['count'], 2)
+            self.assertEqual(get['errors'], 0)
+            self.assertEqual(get['db']['count'], 2)
+            self.assertGreater(get['db']['total'], 0)
+            self.assertGreater(get['send']['total'], 0)
+            self.assertLessEqual(get['db']['total'] + get['serialize']['total']
+                                 + get['send']['total'], get['total']['total'])
+            self.assertEqual(stats['commands']['DeleteStudent']['count'], 1)
+            self.assertEqual(sum(count for bound, count in
+                                 get['total']['buckets']), 2)
+
+
+    def test_StatsLog(self):
+
+        statsLog = 'test_stats.log'
+        self.addCleanup(os.remove, statsLog)
+        self.Logic = Logic.LogicLayer(self.dbname, statsLog=statsLog,
+                                      statsInterval=0.01)
+        self.Logic.ProcessMessage(pickle.dumps(
+            {'cmd':'DeleteStudent', 'data':{'ID':3}}),
+            session=Mock(spec=Logic.ClientSession))
+        self.Logic.Close()
+
+        with open(statsLog) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertGreaterEqual(len(lines), 1)
+        self.assertEqual(lines[-1]['commands']['DeleteStudent']['count'], 1)
+
+
+    def test_ProcessMessage_Batch(self):
+
+        msgdict = {'cmd':'Batch',
+                   'data':{'ops':[{'cmd':'AddStudent',
+                                   'data':{'values':{'first_name':'Luke',
+                                                     'last_name':'Skywalker'}}},
+                                  {'cmd':'DeleteStudent', 'data':{'ID':3}}]}}
+        sendmsg = pickle.dumps(msgdict)
+        reply = pickle.dumps([7, 1])
+        expectedReply = struct.pack('<i', len(reply)) + reply
+
+        TCP_IP = '127.0.0.1'
+        TCP_PORT=5005
+
+        with patch('Logic.socket.socket') as mock_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            mock_socket.return_value.accept.return_value = (sock, TCP_IP)
+            self.Logic = Logic.LogicLayer(self.dbname)
+            self.Logic.ConnectUI(TCP_IP=TCP_IP, TCP_PORT=TCP_PORT)
+            self.Logic.ProcessMessage(sendmsg)
+
+            self.Logic.clientSock.sendall.assert_called_once_with(expectedReply)
+
+
+class TestShardedLogic(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shardNames = ['test_shard%d.db' % i for i in range(3)]
+        self.Logic = Logic.ShardedLogicLayer(self.shardNames)
+        self.Logic.Batch([{'cmd':'AddStudent',
+                           'data':{'values':{'first_name':f, 'last_name':l}}}
+                          for f, l in [('Alyssa', 'Batula'), ('Kaylee', 'Frye'),
+                                       ('Harry', 'Potter'), ('Jon', 'Snow'),
+                                       ('Clara', 'Oswald'), 
+                                       ('Anthony', 'Stark')]])
+
+
+    def tearDown(self):
+
+        self.Logic.Close()
+        for dbName in self.shardNames:
+            os.remove(dbName)
+
+
+    def ShardIDs(self, shard):
+
+        return [row[0] for row in self.Logic.shardConns[shard].execute(
+            'SELECT id FROM students ORDER BY id')]
+
+
+    def test_Routing(self):
+
+        self.assertEqual([self.ShardIDs(shard) for shard in range(3)],
+                         [[3, 6], [1, 4], [2, 5]])
+
+        self.assertEqual(self.Logic.AddStudent({'first_name':'Luke',
+                                                'last_name':'Skywalker'}), 7)
+        self.assertEqual(self.Logic.UpdateStudent(
+            5, {'first_name':'Oswin', 'last_name':'Oswald'}), 1)
+        self.assertEqual(self.Logic.RemoveStudent(3), 1)
+        self.assertEqual(self.Logic.RemoveStudent(3), 0)
+        self.assertEqual([self.ShardIDs(shard) for shard in range(3)],
+                         [[6], [1, 4, 7], [2, 5]])
+        self.assertEqual(self.Logic.version, 9)
+
+        # A new server carries on from the highest ID in any shard
+        self.Logic.Close()
+        self.Logic = Logic.ShardedLogicLayer(self.shardNames)
+        self.assertEqual(self.Logic.nextID, 8)
+        self.Logic.Close()
+
+        # Shards are only opened with the layout they were created with
+        for shardNames, partition in ((self.shardNames, 'range'),
+                                      (self.shardNames[:2], 'hash'),
+                                      (self.shardNames[::-1], 'hash')):
+            with self.assertRaisesRegex(ValueError, 'is shard'):
+                Logic.ShardedLogicLayer(shardNames, partition)
+
+        # An unsharded database is only taken on if its students fit
+        conn = sqlite3.connect('test_plain.db')
+        conn.execute(Logic.SHARD_TABLE)
+        conn.execute("INSERT INTO students VALUES (1, 'Alyssa', 'Batula')")
+        conn.commit()
+        conn.close()
+        self.addCleanup(os.remove, 'test_plain.db')
+        self.addCleanup(os.remove, 'test_shard3.db')
+        with self.assertRaisesRegex(ValueError, 'belongs in shard 0, not 1'):
+            Logic.ShardedLogicLayer(['test_shard3.db', 'test_plain.db'], 
+                                    'range', rangeSize=4)
+
+        # Nothing was marked by the failed attempt
+        self.Logic = Logic.ShardedLogicLayer(['test_plain.db', 
+                                              'test_shard3.db'], 'range', 
+                                             rangeSize=4)
+        self.assertEqual([self.Logic.Shard(id) for id in (1, 4, 5, 9, 100)],
+                         [0, 0, 1, 1, 1])
+        self.assertEqual(self.Logic.UpdateStudent(
+            1, {'first_name':'Aly', 'last_name':'Batula'}), 1)
+
+
+    def test_Queries(self):
+
+        self.assertEqual(self.Logic.GetStudents(asDataFrame=False),
+                         [(1, 'Alyssa', 'Batula'), (2, 'Kaylee', 'Frye'),
+                          (3, 'Harry', 'Potter'), (4, 'Jon', 'Snow'),
+                          (5, 'Clara', 'Oswald'), (6, 'Anthony', 'Stark')])
+
+        rows = self.Logic.SearchStudents(sortBy='last_name', descending=True,
+                                         limit=3, asDataFrame=False)
+        self.assertEqual(rows, [(6, 'Anthony', 'Stark'), (4, 'Jon', 'Snow'),
+                                (3, 'Harry', 'Potter')])
+
+        rows, cursor = self.Logic.GetStudentsPage(4, asDataFrame=False)
+        self.assertEqual([row[0] for row in rows], [1, 2, 3, 4])
+        rows, cursor = self.Logic.GetStudentsPage(4, cursor, 
+                                                  asDataFrame=False)
+        self.assertEqual([row[0] for row in rows], [5, 6])
+        self.assertIsNone(cursor)
+
+        with self.assertRaises(ValueError):
+            self.Logic.Batch([{'cmd':'DeleteStudent', 'data':{'ID':1}},
+                              {'cmd':'RenameStudent', 'data':{'ID':2}}])
+        self.assertEqual(len(self.Logic.GetStudents(asDataFrame=False)), 6)
+
+        # Counts are added up across shards before duplicates are picked
+        self.Logic.AddStudent({'first_name':'Jon', 'last_name':'Snow'})
+        self.Logic.AddStudent({'first_name':'Jon', 'last_name':'Stark'})
+        self.assertEqual(self.Logic.CountStudents(), 8)
+        self.assertEqual(self.Logic.CountByName(prefix='S'), [('S', 4)])
+        self.assertEqual(self.Logic.CountDuplicates(),
+                         {'names':1, 'students':2})
+
+
+class TestLogicAsyncServer(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dbname = 'test.db'
+        self.conn = sqlite3.connect(self.dbname)
+        self.c = self.conn.cursor()
+        self.c.execute('''CREATE TABLE students (id INTEGER PRIMARY KEY, 
+                          first_name, last_name)''')
+
+        self.c.execute("INSERT INTO students VALUES (null, 'Alyssa', 'Batula')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Kaylee', 'Frye')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Harry', 'Potter')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Jon', 'Snow')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Clara', 'Oswald')")
+        self.c.execute("INSERT INTO students VALUES (null, 'Anthony', 'Stark')")
+
+        self.conn.commit()
+
+        self.Logic = Logic.LogicLayer(self.dbname)
+        self.serverThread = threading.Thread(target=self.Logic.ServeAsync,
+                                             kwargs={'TCP_PORT':0})
+        self.serverThread.start()
+        self.assertTrue(self.Logic.serverReady.wait(5), 'Server did not start')
+
+
+    def tearDown(self):
+
+        self.Logic.StopServer()
+        self.serverThread.join(5)
+        self.conn.close()
+        os.remove(self.dbname)
+
+
+    def Connect(self):
+
+        sock = socket.create_connection(self.Logic.serverAddress)
+        sock.sendall(b'Hello Logic')
+        self.assertEqual(sock.recv(len(b'Hello UI')), b'Hello UI')
+        return sock
+
+
+    def Send(self, sock, msgdict):
+
+        sendmsg = pickle.dumps(msgdict)
+        sock.sendall(struct.pack('<i', len(sendmsg)) + sendmsg)
+
+
+    def ReadUntilClosed(self, sock):
+
+        msgs = []
+        msg = Protocol.ReceiveMessage(sock)
+        while msg is not None:
+            msgs.append(msg)
+            msg = Protocol.ReceiveMessage(sock)
+        sock.close()
+        return msgs
+
+
+    def test_ConcurrentClients(self):
+
+        socks = [self.Connect() for i in range(3)]
+
+        # Every client is served while the others are still connected
+        self.Send(socks[0], {'cmd':'AddStudent',
+                             'data':{'values':{'first_name':'Luke',
+                                               'last_name':'Skywalker'}}})
+        self.Send(socks[0], {'cmd':'GetStudents'})
+        self.Send(socks[0], {'cmd':'CloseSocket'})
+        replies = self.ReadUntilClosed(socks[0])
+
+        for sock in socks[1:]:
+            self.Send(sock, {'cmd':'GetStudents'})
+            self.Send(sock, {'cmd':'CloseSocket'})
+        for sock in socks[1:]:
+            replies += self.ReadUntilClosed(sock)
+
+        self.assertEqual(len(replies), 3)
+        for msg in replies:
+            rows = pickle.loads(msg)
+            self.assertEqual(len(rows), 7)
+            self.assertEqual(rows[6], (7, 'Luke', 'Skywalker'))
+
+
 if __name__ == '__main__':
     unittest.main()
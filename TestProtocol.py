@@ -0,0 +1,128 @@
+import unittest
+
+import socket
+import threading
+
+import Protocol
+
+
+class TestProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+
+    def SendInThread(self, payloads):
+        # Large messages do not fit in the socket buffer, so send concurrently
+        thread = threading.Thread(
+            target=lambda: [Protocol.SendMessage(self.sender, p)
+                            for p in payloads])
+        thread.start()
+        return thread
+
+
+    def test_RoundTrip(self):
+
+        payloads = [b'', b'x', b'a' * 1024, b'b' * 2048, bytes(range(256)) * 10]
+        thread = self.SendInThread(payloads)
+
+        for payload in payloads:
+            self.assertEqual(Protocol.ReceiveMessage(self.receiver), payload)
+        thread.join()
+
+
+    def test_LargeMessage(self):
+
+        payload = b'0123456789' * 500000
+        thread = self.SendInThread([payload])
+
+        msg = Protocol.ReceiveMessage(self.receiver)
+        thread.join()
+        self.assertEqual(len(msg), len(payload))
+        self.assertEqual(msg, payload)
+
+
+    def test_Compressed(self):
+
+        payloads = [b'small', b'abc' * 10000, bytes(range(256)) * 100]
+        thread = threading.Thread(
+            target=lambda: [Protocol.SendMessage(self.sender, p, reqID=i,
+                                                 compressAbove=100)
+                            for i, p in enumerate(payloads)])
+        thread.start()
+
+        for i, payload in enumerate(payloads):
+            reqID, body = Protocol.SplitRequestID(
+                Protocol.ReceiveMessage(self.receiver, tagged=True))
+            self.assertEqual((reqID, body), (i, payload))
+        thread.join()
+
+        message = Protocol.EncodeMessage(b'abc' * 10000, compressAbove=100)
+        size, compressed = Protocol.SplitHeader(message[:4])
+        self.assertTrue(compressed)
+        self.assertEqual(size, len(message) - 4)
+        self.assertLess(size, 1000)
+        self.assertEqual(Protocol.SplitHeader(
+            Protocol.EncodeMessage(b'small', compressAbove=100)[:4]), 
+                         (5, False))
+
+
+    def test_ConnectionClosed(self):
+
+        self.sender.close()
+        self.assertIsNone(Protocol.ReceiveMessage(self.receiver))
+
+
+    def test_ConnectionClosedMidMessage(self):
+
+        self.sender.sendall(Protocol.HEADER.pack(10) + b'abc')
+        self.sender.close()
+        with self.assertRaises(ConnectionError):
+            Protocol.ReceiveMessage(self.receiver)
+
+
+
+class TestColumnar(unittest.TestCase):
+
+    def test_RoundTrip(self):
+
+        names = ['ID', 'First Name', 'Last Name']
+        columns = [[1, 2, 3, 2**40],
+                   ['Alyssa', 'Zoë', '', None],
+                   ['Batula', 'Núñez', 'Snow', 'Stark']]
+        table = Protocol.ColumnarTable(Protocol.EncodeColumnar(names, columns))
+
+        self.assertEqual(table.columns, names)
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table.Column('ID').tolist(), [1, 2, 3, 2**40])
+        self.assertEqual(table.Column('First Name')[1], 'Zoë')
+        self.assertEqual(table.Column('First Name')[-1], '')
+        self.assertEqual(table.Row(1), (2, 'Zoë', 'Núñez'))
+        self.assertEqual(table.Rows(), [(1, 'Alyssa', 'Batula'),
+                                        (2, 'Zoë', 'Núñez'),
+                                        (3, '', 'Snow'),
+                                        (2**40, '', 'Stark')])
+
+
+    def test_Empty(self):
+
+        payload = Protocol.EncodeColumnar(['ID', 'Name'], [[], []])
+        table = Protocol.ColumnarTable(payload)
+
+        self.assertEqual(table.columns, ['ID', 'Name'])
+        self.assertEqual(table.Rows(), [])
+
+
+    def test_NotColumnar(self):
+
+        with self.assertRaises(ValueError):
+            Protocol.ColumnarTable(b'\x80\x04' + bytes(20))
+
+
+if __name__ == '__main__':
+    unittest.main()